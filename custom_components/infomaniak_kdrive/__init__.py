@@ -1,19 +1,57 @@
 
 from __future__ import annotations
 import logging
+from datetime import timedelta
 from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import Platform
 from homeassistant.core import HomeAssistant
 from homeassistant.helpers.typing import ConfigType
 from homeassistant.helpers import config_entry_oauth2_flow
+from homeassistant.helpers.event import async_track_time_interval
 from homeassistant.components.application_credentials import (
     async_get_application_credentials,
 )
 
-from .const import DOMAIN, DATA_CLIENT, CONF_TOKEN, CONF_DRIVE_ID, CONF_FOLDER_ID, OAUTH2_AUTHORIZE, OAUTH2_TOKEN
+from .const import (
+    DOMAIN,
+    DATA_CLIENT,
+    DATA_MIRROR,
+    DATA_CATALOG,
+    DATA_ENTRY,
+    DATA_INDEX,
+    DATA_CHUNK_STORE,
+    DATA_OPTIONS,
+    LIVE_OPTIONS,
+    CONF_TOKEN,
+    CONF_DRIVE_ID,
+    CONF_FOLDER_ID,
+    CONF_UPLOAD_CONCURRENCY,
+    CONF_DOWNLOAD_CONCURRENCY,
+    CONF_COMPRESSION,
+    CONF_ENCRYPTION_KEY,
+    CONF_BANDWIDTH_LIMIT,
+    CONF_BANDWIDTH_SCHEDULE,
+    CONF_MIRROR_FOLDER_URL,
+    CONF_AGENT_ID,
+    LEGACY_AGENT_ID,
+    DEFAULT_UPLOAD_CONCURRENCY,
+    DEFAULT_DOWNLOAD_CONCURRENCY,
+    OAUTH2_AUTHORIZE,
+    OAUTH2_TOKEN,
+    VERIFY_INTERVAL,
+    parse_kdrive_folder_url,
+)
+from .backup import create_catalog
 from .client import KDriveClient
+from .dedup import ChunkStore
+from .index import BackupIndex
+from .integrity import async_run_verification
+from .throttle import parse_schedule
 
 _LOGGER = logging.getLogger(__name__)
 
+PLATFORMS = [Platform.SENSOR]
+
 async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
     # Enregistre une implémentation OAuth2 si des "Application Credentials" sont définies dans l'UI HA
     try:
@@ -32,19 +70,47 @@ async def async_setup(hass: HomeAssistant, config: ConfigType) -> bool:
         _LOGGER.debug("No OAuth2 application credentials yet for %s", DOMAIN)
     return True
 
-async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    token = entry.data.get(CONF_TOKEN)
-    drive_id = entry.data[CONF_DRIVE_ID]
-    folder_id = entry.data[CONF_FOLDER_ID]
+async def async_migrate_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    if entry.version != 5:
+        return False
+    if entry.minor_version < 2:
+        # Backups used to go through a single agent with a fixed id. The
+        # first entry migrated keeps it; any other one gets its entry id.
+        data = dict(entry.data)
+        if not any(
+            other.data.get(CONF_AGENT_ID) == LEGACY_AGENT_ID
+            for other in hass.config_entries.async_entries(DOMAIN)
+        ):
+            data[CONF_AGENT_ID] = LEGACY_AGENT_ID
+        hass.config_entries.async_update_entry(entry, data=data, minor_version=2)
+    return True
 
-    client = KDriveClient(
-        hass=hass,
-        token=token,
-        drive_id=drive_id,
-        folder_id=folder_id,
-    )
-    hass.data.setdefault(DOMAIN, {})
-    hass.data[DOMAIN][DATA_CLIENT] = client
+async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
+    # Each entry gets its own clients (and connection pools) and its own
+    # backup agent; everything lives in hass.data[DOMAIN][entry_id]
+    client = _create_client(hass, entry, entry.data[CONF_DRIVE_ID], entry.data[CONF_FOLDER_ID])
+    _configure_limiter(client, entry)
+    data = {
+        DATA_CLIENT: client,
+        DATA_MIRROR: None,
+        DATA_ENTRY: entry,
+        DATA_OPTIONS: _static_options(entry),
+        DATA_INDEX: BackupIndex(client),
+        DATA_CHUNK_STORE: ChunkStore(hass, client, f"{DOMAIN}.chunks_{entry.entry_id}"),
+    }
+    data[DATA_CATALOG] = create_catalog(hass, entry, client, data[DATA_INDEX])
+    mirror_url = entry.options.get(CONF_MIRROR_FOLDER_URL)
+    if mirror_url:
+        try:
+            drive_id, folder_id = parse_kdrive_folder_url(mirror_url)
+        except ValueError as err:
+            _LOGGER.warning("Ignoring mirror folder: %s", err)
+        else:
+            mirror = _create_client(hass, entry, drive_id, folder_id)
+            # One bandwidth budget for both copies
+            mirror.limiter = client.limiter
+            data[DATA_MIRROR] = mirror
+    hass.data.setdefault(DOMAIN, {})[entry.entry_id] = data
 
     def _notify_backup_listeners() -> None:
         for listener in hass.data.get("backup_agent_listeners", []):
@@ -54,12 +120,64 @@ async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
                 _LOGGER.exception("Error notifying backup listeners")
 
     entry.async_on_unload(entry.async_on_state_change(_notify_backup_listeners))
+    entry.async_on_unload(entry.add_update_listener(_async_update_listener))
+
+    async def _async_verify(now) -> None:
+        await async_run_verification(client, data[DATA_INDEX])
+
+    entry.async_on_unload(async_track_time_interval(hass, _async_verify, timedelta(seconds=VERIFY_INTERVAL)))
+    for key in (DATA_CLIENT, DATA_MIRROR):
+        if data[key] is not None:
+            entry.async_create_background_task(hass, data[key].async_cancel_expired_sessions(), f"{DOMAIN} upload journal cleanup")
+    # Warm the catalog so the backup page does not wait for a cold listing
+    entry.async_create_background_task(hass, data[DATA_CATALOG].async_prefetch(), f"{DOMAIN} catalog prefetch")
+    await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
     return True
 
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
-    hass.data.get(DOMAIN, {}).pop(DATA_CLIENT, None)
+    if not await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
+        return False
+    data = hass.data.get(DOMAIN, {}).pop(entry.entry_id, {})
+    if data.get(DATA_CATALOG) is not None:
+        await data[DATA_CATALOG].async_close()
+    for key in (DATA_CLIENT, DATA_MIRROR):
+        if data.get(key) is not None:
+            await data[key].async_close()
     return True
 
+def _create_client(hass: HomeAssistant, entry: ConfigEntry, drive_id: int, folder_id: int) -> KDriveClient:
+    return KDriveClient(
+        hass=hass,
+        token=entry.data.get(CONF_TOKEN),
+        drive_id=drive_id,
+        folder_id=folder_id,
+        upload_concurrency=entry.options.get(CONF_UPLOAD_CONCURRENCY, DEFAULT_UPLOAD_CONCURRENCY),
+        download_concurrency=entry.options.get(CONF_DOWNLOAD_CONCURRENCY, DEFAULT_DOWNLOAD_CONCURRENCY),
+        compression=entry.options.get(CONF_COMPRESSION, False),
+        encryption_key=entry.options.get(CONF_ENCRYPTION_KEY),
+    )
+
+def _static_options(entry: ConfigEntry) -> dict:
+    return {k: v for k, v in entry.options.items() if k not in LIVE_OPTIONS}
+
+def _configure_limiter(client: KDriveClient, entry: ConfigEntry) -> None:
+    try:
+        schedule = parse_schedule(entry.options.get(CONF_BANDWIDTH_SCHEDULE, ""))
+    except ValueError as err:
+        _LOGGER.warning("Ignoring bandwidth schedule: %s", err)
+        schedule = []
+    client.limiter.configure(entry.options.get(CONF_BANDWIDTH_LIMIT, 0), schedule)
+
+async def _async_update_listener(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    # Live options (throttling, retention) apply to running uploads; only the
+    # others need a reload, which would abort an upload in progress
+    data = hass.data.get(DOMAIN, {}).get(entry.entry_id, {})
+    client = data.get(DATA_CLIENT)
+    if client is not None:
+        _configure_limiter(client, entry)
+    if data.get(DATA_OPTIONS) != _static_options(entry):
+        await hass.config_entries.async_reload(entry.entry_id)
+
 async def async_get_config_entry_oauth2_flow(hass):
     from .oauth import OAuth2FlowHandler
     return OAuth2FlowHandler
@@ -1,8 +1,15 @@
 
 from __future__ import annotations
-from typing import Any, AsyncIterator, Callable, Coroutine, List, Dict
+import asyncio
+import logging
+from dataclasses import replace
+from datetime import datetime
+from functools import partial
+from typing import Any, AsyncIterator, Callable, Coroutine, Iterable, List, Dict, Optional
 
+from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.storage import Store
 from homeassistant.components.backup import (
     BackupAgent,
     BackupNotFound,
@@ -10,23 +17,60 @@ from homeassistant.components.backup import (
 )
 from homeassistant.components.backup.util import suggested_filename_from_name_date
 from homeassistant.components.backup.const import DATA_MANAGER
+from homeassistant.util import dt as dt_util
 
 from .const import (
     DOMAIN,
     DATA_CLIENT,
+    DATA_MIRROR,
+    DATA_CATALOG,
+    DATA_ENTRY,
+    DATA_INDEX,
+    DATA_CHUNK_STORE,
     DATA_BACKUP_AGENT_LISTENERS,
     AGENT_NAME,
     ID_TAG,
     VER_TAG,
     PROT_TAG,
+    XF_TAG,
+    XF_CDC,
+    XF_AESGCM,
+    FILENAME_DATE_RE,
+    CATALOG_STORE_VERSION,
+    CONF_KEEP_DAILY,
+    CONF_KEEP_WEEKLY,
+    CONF_KEEP_MONTHLY,
+    CONF_MAX_TOTAL_SIZE,
+    CONF_INCREMENTAL,
+    CONF_AGENT_ID,
 )
+from .catalog import BackupCatalog, CatalogEntry
 from .client import KDriveClient
+from .dedup import ChunkStore
+from .index import BackupIndex
+from .retention import RetentionItem, RetentionPolicy, select_deletions
+from .tee import StreamTee
+
+_LOGGER = logging.getLogger(__name__)
 
 async def async_get_backup_agents(hass: HomeAssistant) -> list[BackupAgent]:
-    if DOMAIN not in hass.data or DATA_CLIENT not in hass.data[DOMAIN]:
-        return []
-    client: KDriveClient = hass.data[DOMAIN][DATA_CLIENT]
-    return [KDriveBackupAgent(hass=hass, client=client)]
+    # One agent per loaded config entry
+    return [_get_agent(hass, data) for data in hass.data.get(DOMAIN, {}).values()]
+
+def _get_agent(hass: HomeAssistant, data: dict) -> KDriveBackupAgent:
+    client: KDriveClient = data[DATA_CLIENT]
+    entry: ConfigEntry = data[DATA_ENTRY]
+    index: BackupIndex = data[DATA_INDEX]
+    catalog: BackupCatalog = data[DATA_CATALOG]
+    return KDriveBackupAgent(
+        hass=hass,
+        entry=entry,
+        client=client,
+        catalog=catalog,
+        index=index,
+        chunk_store=data[DATA_CHUNK_STORE],
+        mirror=data.get(DATA_MIRROR),
+    )
 
 @callback
 def async_register_backup_agents_listener(hass: HomeAssistant, *, listener: Callable[[], None], **kwargs: Any):
@@ -39,16 +83,17 @@ def async_register_backup_agents_listener(hass: HomeAssistant, *, listener: Call
 
 # Helpers
 
-def make_filename(backup: AgentBackup) -> str:
+def make_filename(backup: AgentBackup, transforms: List[str] | None = None) -> str:
     base = suggested_filename_from_name_date(backup.name, backup.date)
     ver = getattr(backup, "homeassistant_version", "") or "unknown"
     prot = "true" if getattr(backup, "protected", False) else "false"
     stem = base[:-4] if base.endswith('.tar') else base
-    return f"{stem}{ID_TAG}{backup.backup_id}{VER_TAG}{ver}{PROT_TAG}{prot}.tar"
+    xf = f"{XF_TAG}{'+'.join(transforms)}" if transforms else ""
+    return f"{stem}{ID_TAG}{backup.backup_id}{VER_TAG}{ver}{PROT_TAG}{prot}{xf}.tar"
 
 
 def try_parse_filename(name: str) -> dict | None:
-    # Forme attendue (ordre stable): <suggested>__id-<id>__ver-<ver>__prot-<true|false>.tar
+    # Forme attendue (ordre stable): <suggested>__id-<id>__ver-<ver>__prot-<true|false>[__xf-<t1+t2>].tar
     if not name.endswith('.tar'):
         return None
     stem = name[:-4]
@@ -56,7 +101,7 @@ def try_parse_filename(name: str) -> dict | None:
         return None
     parts = stem.split('__')
     # parts[0] = suggested prefix
-    meta = {"name_hint": parts[0], "backup_id": None, "version": None, "protected": None}
+    meta = {"name_hint": parts[0], "backup_id": None, "version": None, "protected": None, "date": _parse_filename_date(parts[0]), "transforms": []}
     for p in parts[1:]:
         if p.startswith(ID_TAG.strip('_')):  # 'id-'
             meta["backup_id"] = p[len('id-'):]
@@ -65,12 +110,42 @@ def try_parse_filename(name: str) -> dict | None:
         elif p.startswith(PROT_TAG.strip('_')):  # 'prot-'
             prot_val = p[len('prot-'):].lower()
             meta["protected"] = prot_val == 'true'
+        elif p.startswith(XF_TAG.strip('_')):  # 'xf-'
+            meta["transforms"] = [t for t in p[len('xf-'):].split('+') if t]
     if not meta["backup_id"]:
         return None
     return meta
 
 
+def _parse_filename_date(name_hint: str) -> datetime | None:
+    m = FILENAME_DATE_RE.search(name_hint)
+    if not m:
+        return None
+    try:
+        year, month, day, hour, minute, second, micro = (int(g) for g in m.groups())
+        # The suggested filename drops the offset, HA writes local time
+        return datetime(year, month, day, hour, minute, second, micro, tzinfo=dt_util.get_default_time_zone())
+    except ValueError:
+        return None
+
+
+def _get_file_date(item: dict) -> datetime | None:
+    for key in ("last_modified_at", "created_at"):
+        ts = item.get(key)
+        if isinstance(ts, (int, float)) and ts > 0:
+            return dt_util.utc_from_timestamp(ts)
+    return None
+
+
 def _get_ha_retention_count(hass: HomeAssistant) -> int | None:
+    return _get_ha_retention_setting(hass, 'count', 'copies')
+
+
+def _get_ha_retention_days(hass: HomeAssistant) -> int | None:
+    return _get_ha_retention_setting(hass, 'days')
+
+
+def _get_ha_retention_setting(hass: HomeAssistant, *keys: str) -> int | None:
     try:
         manager = hass.data.get(DATA_MANAGER)
         if not manager:
@@ -78,16 +153,19 @@ def _get_ha_retention_count(hass: HomeAssistant) -> int | None:
         cfg = getattr(manager, 'config', None)
         data = getattr(cfg, 'data', None) if cfg else None
         candidates = []
-        if isinstance(data, dict):
-            if isinstance(data.get('retention'), dict):
-                candidates.append(data['retention'].get('count'))
-            if isinstance(data.get('automatic'), dict):
-                auto = data['automatic']
-                if isinstance(auto.get('retention'), dict):
-                    candidates.append(auto['retention'].get('count'))
-            candidates.append(data.get('retention_count'))
-        if hasattr(cfg, 'retention_count'):
-            candidates.append(getattr(cfg, 'retention_count'))
+        for key in keys:
+            if isinstance(data, dict):
+                if isinstance(data.get('retention'), dict):
+                    candidates.append(data['retention'].get(key))
+                if isinstance(data.get('automatic'), dict):
+                    auto = data['automatic']
+                    if isinstance(auto.get('retention'), dict):
+                        candidates.append(auto['retention'].get(key))
+                candidates.append(data.get(f'retention_{key}'))
+            elif data is not None:
+                candidates.append(getattr(getattr(data, 'retention', None), key, None))
+            if hasattr(cfg, f'retention_{key}'):
+                candidates.append(getattr(cfg, f'retention_{key}'))
         for v in candidates:
             if v is not None:
                 try:
@@ -113,89 +191,320 @@ def _get_current_ha_version(hass: HomeAssistant) -> str:
         pass
     return ""
 
+def create_catalog(hass: HomeAssistant, entry: ConfigEntry, client: KDriveClient, index: BackupIndex) -> BackupCatalog:
+    return BackupCatalog(
+        partial(_async_load_catalog, hass, client, index),
+        store=Store(hass, CATALOG_STORE_VERSION, f"{DOMAIN}.catalog_{entry.entry_id}"),
+    )
+
+def _is_unchanged(previous: dict, item: dict) -> bool:
+    # Same file, not modified since the previous listing
+    stamp = item.get("last_modified_at")
+    return (
+        stamp is not None
+        and previous.get("id") == item.get("id")
+        and previous.get("last_modified_at") == stamp
+        and previous.get("size") == item.get("size")
+    )
+
+async def _async_load_catalog(
+    hass: HomeAssistant,
+    client: KDriveClient,
+    index: BackupIndex,
+    previous: Dict[str, CatalogEntry] | None = None,
+) -> Dict[str, CatalogEntry]:
+    # Entries of `previous` (the last known listing) read from the index are
+    # reused while neither their file nor the index changed; the index is read
+    # only if another file needs it. Entries rebuilt from the filename are
+    # resolved again: the index may just not have been written yet.
+    items = await client.list_folder_files()
+    parsed = [(it, meta) for it in items if (meta := try_parse_filename(it.get("name", "")))]
+    index_file = next((it for it in items if BackupIndex.is_index_file(it)), None)
+
+    entries: Dict[str, CatalogEntry] = {}
+    changed: list[tuple[dict, dict]] = []
+    for it, meta in parsed:
+        prev = (previous or {}).get(meta["backup_id"])
+        if (
+            prev is not None
+            and prev.index_file is not None
+            and index_file is not None
+            and _is_unchanged(prev.index_file, index_file)
+            and _is_unchanged(prev.file, it)
+        ):
+            entries[meta["backup_id"]] = replace(prev, file=it)
+        else:
+            changed.append((it, meta))
+    indexed = {}
+    if changed:
+        indexed = await index.async_load(index_file)
+
+    legacy: list[tuple[dict, dict]] = []
+    for it, meta in changed:
+        known = indexed.get(meta["backup_id"])
+        if known and known.get("file_name") == it.get("name"):
+            try:
+                backup = AgentBackup.from_dict(known["backup"])
+            except Exception:
+                legacy.append((it, meta))
+                continue
+            date = dt_util.parse_datetime(backup.date) if backup.date else None
+            entries[backup.backup_id] = CatalogEntry(
+                backup=backup,
+                file=it,
+                date=date or _get_file_date(it),
+                transforms=meta["transforms"],
+                index_file=index_file,
+            )
+        else:
+            legacy.append((it, meta))
+
+    # Backups that predate the index: rebuild what we can from the filename.
+    # Resolve the missing sizes concurrently, the client bounds the lookups
+    async def resolve_size(it: dict) -> int:
+        if it.get("size") is not None:
+            return int(it["size"])
+        try:
+            return await client.get_file_size(it["id"])
+        except Exception as err:
+            _LOGGER.debug("Could not get the size of %s: %r", it.get("name"), err)
+            return 0
+    sizes = await asyncio.gather(*(resolve_size(it) for it, _ in legacy))
+
+    default_version = _get_current_ha_version(hass)
+    for (it, meta), size_val in zip(legacy, sizes):
+        date = meta["date"] or _get_file_date(it)
+        entries[meta["backup_id"]] = CatalogEntry(
+            backup=AgentBackup(
+                backup_id=meta["backup_id"],
+                name=meta["name_hint"],
+                date=date.isoformat() if date else None,
+                folders=[],
+                homeassistant_included=True,
+                homeassistant_version=meta.get("version") or default_version,
+                protected=bool(meta.get("protected", False)),
+                size=int(size_val or 0),
+                database_included=True,
+                addons=[],
+                extra_metadata={"source": "kdrive"},
+            ),
+            file=it,
+            date=date,
+            transforms=meta["transforms"],
+        )
+    return entries
+
+def _stored_size(entry: CatalogEntry) -> int:
+    # Space taken on kDrive: compressed backups are smaller than the archive.
+    # An incremental backup's file is only its recipe, its chunks are shared,
+    # so it counts as the whole archive
+    size = entry.file.get("size")
+    if size is None or XF_CDC in entry.transforms:
+        return entry.backup.size
+    return int(size)
+
+
 class KDriveBackupAgent(BackupAgent):
     domain = DOMAIN
-    name = AGENT_NAME
-    unique_id = "infomaniak_kdrive_default"
 
-    def __init__(self, hass: HomeAssistant, client: KDriveClient) -> None:
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        entry: ConfigEntry,
+        client: KDriveClient,
+        catalog: BackupCatalog,
+        index: BackupIndex,
+        chunk_store: ChunkStore,
+        mirror: Optional[KDriveClient] = None,
+    ) -> None:
         self._hass = hass
+        self._entry = entry
         self._client = client
+        self._catalog = catalog
+        self._index = index
+        self._chunk_store = chunk_store
+        self._mirror = mirror
+        self.name = entry.title or AGENT_NAME
+        # Entries set up before per-entry agents keep their agent id, so the
+        # backup settings still point to them
+        self.unique_id = entry.data.get(CONF_AGENT_ID, entry.entry_id)
+
+    def _options(self) -> dict:
+        return self._entry.options
 
     async def async_upload_backup(self, *, open_stream: Callable[[], Coroutine[Any, Any, AsyncIterator[bytes]]], backup: AgentBackup, **kwargs: Any) -> None:
-        filename = make_filename(backup)
+        # Protected backups are already encrypted by HA: they neither compress
+        # nor deduplicate
+        incremental = self._options().get(CONF_INCREMENTAL, False) and not backup.protected
+        if incremental:
+            transforms = [XF_CDC]
+        else:
+            transforms = [] if backup.protected else self._client.transforms
+        filename = make_filename(backup, transforms)
         size_hint = getattr(backup, "size", None)
-        await self._client.upload_stream_to_folder(filename=filename, open_stream=open_stream, size_hint=size_hint)
-        retention = _get_ha_retention_count(self._hass)
-        if retention is not None and retention > 0:
-            await self._enforce_retention(retention)
+        # Passed by HA versions that report upload progress
+        report = kwargs.get("on_progress")
+        on_progress = (lambda stored: report(bytes_uploaded=stored)) if report else None
+        try:
+            if incremental:
+                stored = await self._chunk_store.async_upload(await open_stream(), filename)
+            elif self._mirror is not None:
+                stored = await self._async_upload_mirrored(filename, open_stream, size_hint, transforms, on_progress)
+            else:
+                stored = await self._client.upload_stream_to_folder(
+                    filename=filename,
+                    open_stream=open_stream,
+                    size_hint=size_hint,
+                    transforms=transforms,
+                    on_progress=on_progress,
+                )
+            try:
+                await self._index.async_put(backup, filename, sha256=stored["sha256"], size=stored["size"])
+            except Exception as err:
+                _LOGGER.warning("Could not add %s to the backup index: %r", backup.backup_id, err)
+        finally:
+            self._catalog.invalidate()
+        policy = self._get_retention_policy()
+        if policy.enabled:
+            await self._enforce_retention(policy)
 
-    async def async_list_backups(self, **kwargs: Any) -> list[AgentBackup]:
-        items = await self._client.list_folder_files()
-        backups: list[AgentBackup] = []
-        default_version = _get_current_ha_version(self._hass)
-        for it in items:
-            name = it.get("name", "")
-            meta = try_parse_filename(name)
-            if not meta:
-                continue
-            size_val = it.get("size")
-            if size_val is None:
-                try:
-                    size_val = await self._client.get_file_size(it["id"])
-                except Exception:
-                    size_val = 0
-            backups.append(
-                AgentBackup(
-                    backup_id=meta["backup_id"],
-                    name=meta["name_hint"],
-                    date=None,
-                    folders=[],
-                    homeassistant_included=True,
-                    homeassistant_version=meta.get("version") or default_version,
-                    protected=bool(meta.get("protected", False)),
-                    size=int(size_val or 0),
-                    database_included=True,
-                    addons=[],
-                    extra_metadata={"source": "kdrive"},
+    async def _async_upload_mirrored(self, filename: str, open_stream, size_hint, transforms: List[str], on_progress) -> Dict[str, Any]:
+        # The backup is read (and transformed) once and streamed to both
+        # folders at the same pace. Only the primary copy must succeed.
+        if transforms:
+            open_stream = self._client.transformed(open_stream, transforms)
+            size_hint = None
+        tee = StreamTee(open_stream, 2)
+
+        async def upload(index: int, client: KDriveClient, progress) -> Dict[str, Any]:
+            try:
+                return await client.upload_stream_to_folder(
+                    filename=filename,
+                    open_stream=tee.opener(index),
+                    size_hint=size_hint,
+                    on_progress=progress,
+                    resumable=XF_AESGCM not in transforms,
                 )
+            finally:
+                tee.detach(index)
+
+        try:
+            primary, mirror = await asyncio.gather(
+                upload(0, self._client, on_progress),
+                upload(1, self._mirror, None),
+                return_exceptions=True,
             )
-        return backups
+        finally:
+            await tee.aclose()
+        if isinstance(mirror, BaseException):
+            _LOGGER.warning("Could not upload %s to the mirror folder: %r", filename, mirror)
+        if isinstance(primary, BaseException):
+            raise primary
+        return primary
+
+    async def _async_delete_mirrored(self, filenames: Iterable[str]) -> None:
+        # Mirror copies carry the same file name as the primary ones
+        if self._mirror is None:
+            return
+        names = set(filenames)
+        try:
+            ids = [it["id"] async for it in self._mirror.iter_folder_files() if it.get("name") in names]
+            failed = await self._mirror.delete_files(ids)
+        except Exception as err:
+            _LOGGER.warning("Could not clean up the mirror folder: %r", err)
+            return
+        if failed:
+            _LOGGER.warning("Could not delete %d file(s) from the mirror folder", len(failed))
+
+    async def async_list_backups(self, **kwargs: Any) -> list[AgentBackup]:
+        # Right after startup this is the persisted listing, refreshed in the
+        # background
+        entries = await self._catalog.async_entries(allow_stale=True)
+        return [entry.backup for entry in entries.values()]
 
     async def async_get_backup(self, backup_id: str, **kwargs: Any) -> AgentBackup:
-        for b in await self.async_list_backups():
-            if b.backup_id == backup_id:
-                return b
-        raise BackupNotFound(f"Backup not found: {backup_id}")
+        entry = await self._catalog.async_get(backup_id)
+        if entry is None:
+            raise BackupNotFound(f"Backup not found: {backup_id}")
+        return entry.backup
 
     async def async_download_backup(self, backup_id: str, **kwargs: Any) -> AsyncIterator[bytes]:
-        items = await self._client.list_folder_files()
-        # Le nom contient toujours __id-<id>
-        match = next((it for it in items if f"__id-{backup_id}" in it.get("name", "") and it.get("name", "").endswith('.tar')), None)
-        if not match:
+        entry = await self._catalog.async_get(backup_id)
+        if entry is None:
             raise BackupNotFound(f"Archive not found for {backup_id}")
-        return await self._client.download_file_stream(match["id"])
+        if XF_CDC in entry.transforms:
+            return self._chunk_store.async_download(entry.file["id"])
+        remote_size = entry.file.get("size")
+        if remote_size is None and not entry.transforms:
+            remote_size = entry.backup.size
+        return self._client.download_file_stream(entry.file["id"], size=remote_size, transforms=entry.transforms)
 
     async def async_delete_backup(self, backup_id: str, **kwargs: Any) -> None:
-        items = await self._client.list_folder_files()
-        match = next((it for it in items if f"__id-{backup_id}" in it.get("name", "") and it.get("name", "").endswith('.tar')), None)
-        if not match:
+        entry = await self._catalog.async_get(backup_id)
+        if entry is None:
             raise BackupNotFound(f"No remote file for {backup_id}")
-        await self._client.delete_file(match["id"])
-        await self._client.delete_file_from_trash(match["id"])
-
-    async def _enforce_retention(self, retention_count: int) -> None:
-        items = await self._client.list_folder_files()
-        candidates: list[dict] = []
-        for it in items:
-            if try_parse_filename(it.get("name", "")):
-                candidates.append(it)
-        if len(candidates) <= retention_count:
+        try:
+            await self._client.delete_file(entry.file["id"])
+            await self._client.delete_file_from_trash(entry.file["id"])
+            await self._async_unindex([backup_id])
+        finally:
+            self._catalog.invalidate()
+        await self._async_delete_mirrored([entry.file.get("name")])
+        if XF_CDC in entry.transforms:
+            await self._async_collect_chunks()
+
+    async def _async_collect_chunks(self) -> None:
+        # Drop the chunks only the deleted recipes referred to
+        async def list_recipes() -> List[int]:
+            # A fresh listing: recipes uploaded meanwhile must be seen
+            self._catalog.invalidate()
+            entries = await self._catalog.async_entries()
+            return [entry.file["id"] for entry in entries.values() if XF_CDC in entry.transforms]
+
+        try:
+            await self._chunk_store.async_collect_garbage(list_recipes)
+        except Exception as err:
+            _LOGGER.warning("Could not clean up unreferenced chunks: %r", err)
+
+    async def _async_unindex(self, backup_ids: list[str]) -> None:
+        try:
+            await self._index.async_remove(backup_ids)
+        except Exception as err:
+            _LOGGER.warning("Could not update the backup index: %r", err)
+
+    def _get_retention_policy(self) -> RetentionPolicy:
+        options = self._options()
+        max_total_gib = options.get(CONF_MAX_TOTAL_SIZE) or 0
+        return RetentionPolicy(
+            keep_last=_get_ha_retention_count(self._hass),
+            keep_within_days=_get_ha_retention_days(self._hass),
+            keep_daily=options.get(CONF_KEEP_DAILY, 0),
+            keep_weekly=options.get(CONF_KEEP_WEEKLY, 0),
+            keep_monthly=options.get(CONF_KEEP_MONTHLY, 0),
+            max_total_size=int(max_total_gib * 1024 ** 3) or None,
+        )
+
+    async def _enforce_retention(self, policy: RetentionPolicy) -> None:
+        # One listing (through the catalog), one pass to pick the deletions
+        entries = await self._catalog.async_entries()
+        oldest = dt_util.utc_from_timestamp(0)
+        items = [
+            RetentionItem(key=entry.file["id"], date=entry.date or oldest, size=_stored_size(entry))
+            for entry in entries.values()
+        ]
+        surplus = select_deletions(items, policy, dt_util.utcnow())
+        if not surplus:
             return
-        candidates.sort(key=lambda it: it.get("name", ""))
-        surplus = candidates[:-retention_count]
-        for it in surplus:
-            try:
-                await self._client.delete_file(it["id"])
-            except Exception:
-                continue
+        names = {entry.file["id"]: entry.file.get("name") for entry in entries.values()}
+        ids = {entry.file["id"]: backup_id for backup_id, entry in entries.items()}
+        try:
+            failed = await self._client.delete_files([it.key for it in surplus])
+            await self._async_unindex([ids[it.key] for it in surplus if it.key not in failed])
+        finally:
+            self._catalog.invalidate()
+        if failed:
+            # Still listed remotely, so the next run picks them up again
+            _LOGGER.warning("Retention could not delete %d backup(s): %s", len(failed), [names[i] for i in failed])
+        await self._async_delete_mirrored(names[it.key] for it in surplus if it.key not in failed)
+        if any(XF_CDC in entries[ids[it.key]].transforms for it in surplus):
+            await self._async_collect_chunks()
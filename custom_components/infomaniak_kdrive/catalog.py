@@ -0,0 +1,151 @@
+
+from __future__ import annotations
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from homeassistant.components.backup import AgentBackup
+from homeassistant.helpers.storage import Store
+
+from .const import CATALOG_SAVE_DELAY, CATALOG_TTL
+
+_LOGGER = logging.getLogger(__name__)
+
+# File item fields the catalog relies on, the only ones persisted
+_FILE_KEYS = ("id", "name", "size", "last_modified_at", "created_at")
+
+@dataclass
+class CatalogEntry:
+    backup: AgentBackup
+    file: dict  # raw kDrive file item
+    date: Optional[datetime] = None
+    transforms: List[str] = field(default_factory=list)  # applied before upload
+    # Index file item the entry was read from, None when it was rebuilt from
+    # the filename alone
+    index_file: Optional[dict] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "backup": self.backup.as_dict(),
+            "file": _file_stamp(self.file),
+            "date": self.date.isoformat() if self.date else None,
+            "transforms": self.transforms,
+            "index_file": _file_stamp(self.index_file) if self.index_file else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> CatalogEntry:
+        return cls(
+            backup=AgentBackup.from_dict(data["backup"]),
+            file=data["file"],
+            date=datetime.fromisoformat(data["date"]) if data.get("date") else None,
+            transforms=data.get("transforms", []),
+            index_file=data.get("index_file"),
+        )
+
+
+def _file_stamp(item: dict) -> dict:
+    return {k: item[k] for k in _FILE_KEYS if k in item}
+
+
+class BackupCatalog:
+    # In-memory index of the remote backups keyed by backup_id. Concurrent
+    # callers share a single folder listing until the TTL expires.
+    # The last listing is persisted: after a restart it is served to the
+    # backup page while the first listing runs, and it is handed to the
+    # loader so entries of unchanged files are reused. Serving it starts that
+    # listing in the background when none is running, so a failed prefetch
+    # does not leave the page on the snapshot.
+
+    def __init__(
+        self,
+        loader: Callable[[Optional[Dict[str, CatalogEntry]]], Awaitable[Dict[str, CatalogEntry]]],
+        ttl: float = CATALOG_TTL,
+        store: Optional[Store] = None,
+    ) -> None:
+        self._loader = loader
+        self._ttl = ttl
+        self._store = store
+        self._entries: Optional[Dict[str, CatalogEntry]] = None
+        self._expires_at = 0.0
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._known: Optional[Dict[str, CatalogEntry]] = None  # last listing, fresh or not
+        self._snapshot: Optional[Dict[str, CatalogEntry]] = None  # persisted, servable until a listing
+        self._snapshot_loaded = store is None
+        self._refresh: Optional[asyncio.Task] = None
+
+    def _is_fresh(self) -> bool:
+        return self._entries is not None and time.monotonic() < self._expires_at
+
+    async def _async_load_snapshot(self) -> None:
+        if self._snapshot_loaded:
+            return
+        self._snapshot_loaded = True
+        data = await self._store.async_load()
+        if not data:
+            return  # first run
+        entries: Dict[str, CatalogEntry] = {}
+        for backup_id, raw in data.get("entries", {}).items():
+            try:
+                entries[backup_id] = CatalogEntry.from_dict(raw)
+            except Exception:
+                continue
+        if self._known is None:
+            self._known = entries
+            if not self._generation:  # nothing changed since this session started
+                self._snapshot = entries
+
+    def _data(self) -> dict:
+        return {"entries": {backup_id: entry.as_dict() for backup_id, entry in (self._known or {}).items()}}
+
+    async def async_entries(self, allow_stale: bool = False) -> Dict[str, CatalogEntry]:
+        # `allow_stale` serves the persisted listing while no listing was done
+        if self._is_fresh():
+            return self._entries
+        if allow_stale:
+            await self._async_load_snapshot()
+            if self._snapshot is not None:
+                if self._refresh is None or self._refresh.done():
+                    self._refresh = asyncio.create_task(self.async_prefetch())
+                return self._snapshot
+        async with self._lock:
+            if not self._is_fresh():
+                await self._async_load_snapshot()
+                generation = self._generation
+                entries = await self._loader(self._known)
+                if generation != self._generation:
+                    # Invalidated while listing: serve it once, but neither
+                    # cache it nor hand it to the next listing
+                    return entries
+                self._known = entries
+                self._snapshot = None
+                if self._store is not None:
+                    self._store.async_delay_save(self._data, CATALOG_SAVE_DELAY)
+                self._entries = entries
+                self._expires_at = time.monotonic() + self._ttl
+            return self._entries
+
+    async def async_get(self, backup_id: str) -> Optional[CatalogEntry]:
+        return (await self.async_entries()).get(backup_id)
+
+    async def async_prefetch(self) -> None:
+        # Background warm-up after setup
+        try:
+            await self.async_entries()
+        except Exception as err:
+            _LOGGER.debug("Backup catalog refresh failed: %r", err)
+
+    async def async_close(self) -> None:
+        if self._refresh is not None:
+            self._refresh.cancel()
+            await asyncio.gather(self._refresh, return_exceptions=True)
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self._entries = None
+        self._expires_at = 0.0
+        self._snapshot = None
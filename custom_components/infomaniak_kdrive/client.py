@@ -1,201 +1,925 @@
 
 from __future__ import annotations
+import asyncio
 import hashlib
+import itertools
+import logging
 import math
-from typing import AsyncIterator, Dict, List, Optional
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Sequence, Set, TypeVar
 import os
 import tempfile
 import aiohttp
 
-# import logging
-# logging.basicConfig(level=logging.INFO, format='%(levelname)s - %(message)s')
-# _LOGGER = logging.getLogger(__name__)
-
-from homeassistant.core import HomeAssistant
+from homeassistant.const import EVENT_HOMEASSISTANT_CLOSE
+from homeassistant.core import Event, HomeAssistant
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.util import dt as dt_util
+
+from .const import (
+    API_URL,
+    DOMAIN,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_OPEN_TIME,
+    DEFAULT_DOWNLOAD_CONCURRENCY,
+    DELETE_CONCURRENCY,
+    DEFAULT_UPLOAD_CONCURRENCY,
+    DOWNLOAD_RANGE_RETRIES,
+    DOWNLOAD_RANGE_SIZE,
+    DIRECT_UPLOAD_DEFAULT_SIZE,
+    DIRECT_UPLOAD_MAX_SIZE,
+    DIRECT_UPLOAD_MAX_TIME,
+    DIRECT_UPLOAD_MIN_SIZE,
+    LIST_CONCURRENCY,
+    LIST_PAGE_SIZE,
+    REQUEST_RETRIES,
+    RETRY_MAX_DELAY,
+    SESSION_CONCURRENCY,
+    SIZE_LOOKUP_CONCURRENCY,
+    SPOOL_DIR,
+    SPOOL_WRITE_SIZE,
+    UPLOAD_CHUNK_RETRIES,
+    UPLOAD_CONNECT_TIMEOUT,
+    UPLOAD_DNS_CACHE_TTL,
+    UPLOAD_KEEPALIVE_TIMEOUT,
+    UPLOAD_READ_TIMEOUT,
+    RETRY_BASE_DELAY,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_MAX_BUFFER,
+    UPLOAD_MAX_CHUNK_SIZE,
+    UPLOAD_TARGET_CHUNKS,
+    XF_AESGCM,
+    XF_ZSTD,
+)
+from .journal import UploadJournal
+from .stats import TransferStats, TransferTimer
+from .throttle import BandwidthLimiter, Profile
+from .transform import apply_transforms, revert_transforms
+
+_LOGGER = logging.getLogger(__name__)
+
+_T = TypeVar("_T")
 
 class KDriveClient:
-    def __init__(self, hass: HomeAssistant, token: Optional[str], drive_id: int, folder_id: int):
+    def __init__(
+        self,
+        hass: HomeAssistant,
+        token: Optional[str],
+        drive_id: int,
+        folder_id: int,
+        upload_concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+        download_concurrency: int = DEFAULT_DOWNLOAD_CONCURRENCY,
+        compression: bool = False,
+        encryption_key: Optional[str] = None,
+        bandwidth_limit: int = 0,
+        bandwidth_schedule: Optional[List[Profile]] = None,
+        api_url: str = API_URL,
+    ):
         self._hass = hass
         self._token = token
         self._drive_id = drive_id
         self._folder_id = folder_id
+        self._upload_concurrency = max(1, upload_concurrency)
+        self._download_concurrency = max(1, download_concurrency)
+        self._compression = compression
+        self._encryption_key = encryption_key or None
+        self.limiter = BandwidthLimiter(bandwidth_limit, bandwidth_schedule)
         self._session = async_get_clientsession(hass)
-        self._base_v3 = f"https://api.infomaniak.com/3/drive/{drive_id}"
-        self._base_v2 = f"https://api.infomaniak.com/2/drive/{drive_id}"
+        self._base_v3 = f"{api_url}/3/drive/{drive_id}"
+        self._base_v2 = f"{api_url}/2/drive/{drive_id}"
         self._headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self._size_cache: Dict[int, int] = {}
+        self._pending_trash: Set[int] = set()
+        self._upload_session: Optional[aiohttp.ClientSession] = None
+        self._unsub_close: Optional[Callable[[], None]] = None
+        self._journal = UploadJournal(hass, f"{DOMAIN}.uploads_{drive_id}_{folder_id}")
+        self._breaker = _CircuitBreaker()
+        # Requests in flight per endpoint family, see _open()
+        self._limits = {
+            "list": asyncio.Semaphore(LIST_CONCURRENCY),
+            "meta": asyncio.Semaphore(SIZE_LOOKUP_CONCURRENCY),
+            "download": asyncio.Semaphore(self._download_concurrency + 1),
+            "upload": asyncio.Semaphore(self._upload_concurrency + 1),
+            "session": asyncio.Semaphore(SESSION_CONCURRENCY),
+            "delete": asyncio.Semaphore(DELETE_CONCURRENCY),
+        }
+        self.stats = TransferStats()
+
+    @property
+    def upload_concurrency(self) -> int:
+        return self._upload_concurrency
+
+    @property
+    def transforms(self) -> List[str]:
+        # Client-side transforms to apply to new uploads, in order
+        transforms = []
+        if self._compression:
+            transforms.append(XF_ZSTD)
+        if self._encryption_key:
+            transforms.append(XF_AESGCM)
+        return transforms
+
+    def _get_upload_session(self) -> aiohttp.ClientSession:
+        # Long-lived pool for upload traffic: keeps TLS connections and DNS
+        # answers across chunks and across backups.
+        if self._upload_session is None or self._upload_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._upload_concurrency + 2,  # chunks + start/finish/cancel
+                ttl_dns_cache=UPLOAD_DNS_CACHE_TTL,
+                keepalive_timeout=UPLOAD_KEEPALIVE_TIMEOUT,
+                enable_cleanup_closed=True,
+            )
+            self._upload_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=UPLOAD_CONNECT_TIMEOUT,
+                    sock_read=UPLOAD_READ_TIMEOUT,
+                ),
+            )
+            if self._unsub_close is None:
+                # Not HA's shared pool, so HA does not close it on shutdown
+                self._unsub_close = self._hass.bus.async_listen_once(EVENT_HOMEASSISTANT_CLOSE, self._async_on_hass_close)
+        return self._upload_session
+
+    async def _async_on_hass_close(self, event: Event) -> None:
+        self._unsub_close = None
+        await self.async_close()
+
+    async def async_close(self) -> None:
+        if self._unsub_close is not None:
+            self._unsub_close()
+            self._unsub_close = None
+        if self._upload_session is not None:
+            await self._upload_session.close()
+            self._upload_session = None
+
+    @asynccontextmanager
+    async def _open(
+        self,
+        method: str,
+        url: str,
+        *,
+        endpoint: str,
+        session: Optional[aiohttp.ClientSession] = None,
+        headers: Optional[Dict[str, str]] = None,
+        data: Any = None,
+        paced: bool = False,
+        **kwargs: Any,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        # One attempt of a request: waits while the circuit breaker is open,
+        # holds a slot of the endpoint family and yields the response once its
+        # status is checked. `paced` feeds a bytes body through the limiter.
+        await self._breaker.wait()
+        headers = headers or self._headers
+        if paced and self.limiter.enabled:
+            headers = {**headers, "Content-Length": str(len(data))}
+            data = self.limiter.pace_bytes(data)
+        healthy: Optional[bool] = None
+        try:
+            async with self._limits[endpoint]:
+                async with (session or self._session).request(method, url, headers=headers, data=data, **kwargs) as resp:
+                    resp.raise_for_status()
+                    yield resp
+            healthy = True
+        except Exception as err:
+            healthy = not _is_transient(err)
+            raise
+        finally:
+            self._breaker.record(healthy)
+
+    async def _request(
+        self,
+        method: str,
+        url: str,
+        *,
+        endpoint: str,
+        read: Optional[Callable[[aiohttp.ClientResponse], Awaitable[_T]]] = None,
+        retries: int = REQUEST_RETRIES,
+        timer: Optional[TransferTimer] = None,
+        **kwargs: Any,
+    ) -> Optional[_T]:
+        # Central request executor: sends the request through _open() and
+        # retries transient failures, `read` included. A streaming body can
+        # only be sent once, so it is never retried.
+        data = kwargs.get("data")
+        if data is not None and not isinstance(data, (bytes, bytearray)):
+            retries = 0
+        attempt = 0
+        while True:
+            try:
+                async with self._open(method, url, endpoint=endpoint, **kwargs) as resp:
+                    return await read(resp) if read else None
+            except Exception as err:
+                if not await self._retry_wait(err, attempt, retries, timer):
+                    raise
+                attempt += 1
+
+    async def _retry_wait(self, err: Exception, attempt: int, retries: int, timer: Optional[TransferTimer] = None) -> bool:
+        # Sleeps before the next attempt; False when `err` must not be retried
+        if attempt >= retries or not _is_transient(err):
+            return False
+        delay = _retry_delay(err, attempt)
+        self.stats.record_retry(timer)
+        _LOGGER.debug("Retrying in %.1fs after %r", delay, err)
+        await asyncio.sleep(delay)
+        return True
 
     async def list_folder_files(self) -> List[Dict]:
-        url = f"{self._base_v3}/files/{self._folder_id}/files"
-        async with self._session.get(url, headers=self._headers) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            items = data.get("data", [])
-            return [it for it in items if it.get("type") == "file"]
+        start = time.monotonic()
+        items = [it async for it in self.iter_folder_files()]
+        latency = time.monotonic() - start
+        self.stats.record_list(latency)
+        _LOGGER.debug("Listed %d files in %.3fs", len(items), latency)
+        return items
+
+    async def iter_folder_files(self, folder_id: Optional[int] = None, types: Sequence[str] = ("file",)) -> AsyncIterator[Dict]:
+        # Follow the listing cursor page by page; callers may stop early.
+        # The endpoint has no type filter, other types are skipped here.
+        url = f"{self._base_v3}/files/{folder_id or self._folder_id}/files"
+        params = {"limit": LIST_PAGE_SIZE}
+        while True:
+            data = await self._request("GET", url, endpoint="list", params=params, read=_read_json)
+            for it in data.get("data", []):
+                if it.get("type") in types:
+                    yield it
+            cursor = data.get("cursor")
+            if not data.get("has_more") or not cursor:
+                break
+            params = {"limit": LIST_PAGE_SIZE, "cursor": cursor}
 
     async def get_file_size(self, file_id: int) -> int:
+        if file_id in self._size_cache:
+            return self._size_cache[file_id]
         url = f"{self._base_v3}/files/{file_id}/download"
         try:
-            async with self._session.head(url, headers=self._headers) as resp:
-                if resp.status < 400:
-                    cl = resp.headers.get('Content-Length')
-                    if cl is not None:
-                        try:
-                            return int(cl)
-                        except ValueError:
-                            pass
-        except Exception:
-            pass
-        try:
-            async with self._session.get(url, headers=self._headers) as resp:
-                resp.raise_for_status()
-                cl = resp.headers.get('Content-Length')
-                if cl is not None:
-                    try:
-                        return int(cl)
-                    except ValueError:
-                        pass
-        except Exception:
-            pass
-        return 0
+            size = await self._request("HEAD", url, endpoint="meta", read=_read_size)
+        except aiohttp.ClientResponseError as err:
+            if err.status not in (405, 501):  # HEAD not supported
+                raise
+            size = None
+        if size is None:
+            # Ask for the first byte only; the total is in Content-Range
+            headers = {**self._headers, "Range": "bytes=0-0"}
+            size = await self._request("GET", url, endpoint="meta", headers=headers, read=_read_size)
+        if size is None:
+            raise ValueError(f"No size reported for file {file_id}")
+        self._size_cache[file_id] = size
+        return size
+
+    async def download_bytes(self, file_id: int) -> bytes:
+        # For small files only (the backup index)
+        url = f"{self._base_v3}/files/{file_id}/download"
+        return await self._request("GET", url, endpoint="download", read=_read_bytes)
+
+    async def upload_bytes(self, filename: str, data: bytes, conflict: str = "error", directory_id: Optional[int] = None) -> Dict:
+        # Single-request upload of a small file; conflict="version" replaces
+        # an existing file with the same name in place. Returns the file item.
+        url = f"{self._base_v3}/upload"
+        params = {
+            "total_size": len(data),
+            "directory_id": directory_id or self._folder_id,
+            "file_name": filename,
+            "conflict": conflict,
+        }
+        body = await self._request("POST", url, endpoint="upload", params=params, data=data, paced=True, read=_read_json)
+        result = body.get("data") or {}
+        return result.get("file", result)
+
+    async def create_directory(self, name: str, parent_id: Optional[int] = None) -> Dict:
+        url = f"{self._base_v3}/files/{parent_id or self._folder_id}/directory"
+        body = await self._request("POST", url, endpoint="meta", json={"name": name}, read=_read_json)
+        return body.get("data") or {}
 
     async def delete_file(self, file_id: int) -> None:
         url = f"{self._base_v2}/files/{file_id}"
-        async with self._session.delete(url, headers=self._headers) as resp:
-            resp.raise_for_status()
+        await self._request("DELETE", url, endpoint="delete")
 
     async def delete_file_from_trash(self, file_id: int) -> None:
         url = f"{self._base_v2}/trash/{file_id}"
-        async with self._session.delete(url, headers=self._headers) as resp:
-            resp.raise_for_status()
+        await self._request("DELETE", url, endpoint="delete")
+
+    async def delete_files(self, file_ids: List[int]) -> List[int]:
+        # Deletes the files and purges them from the trash, a few at a time
+        # (the "delete" endpoint cap). Returns the ids that could not be
+        # deleted. Failed trash purges are remembered and retried on the next
+        # call.
+        retry_purge = self._pending_trash - set(file_ids)
+
+        async def purge(file_id: int) -> None:
+            try:
+                await self.delete_file_from_trash(file_id)
+            except aiohttp.ClientResponseError as err:
+                if err.status != 404:  # already gone
+                    raise
+            self._pending_trash.discard(file_id)
 
-    async def download_file_stream(self, file_id: int) -> AsyncIterator[bytes]:
+        async def delete(file_id: int) -> bool:
+            try:
+                await self.delete_file(file_id)
+            except aiohttp.ClientResponseError as err:
+                # A 404 after a retry means the first attempt went through
+                if err.status != 404:
+                    _LOGGER.warning("Could not delete file %s: %r", file_id, err)
+                    return False
+            except Exception as err:
+                _LOGGER.warning("Could not delete file %s: %r", file_id, err)
+                return False
+            self._pending_trash.add(file_id)
+            try:
+                await purge(file_id)
+            except Exception as err:
+                _LOGGER.warning("Could not purge file %s from the trash: %r", file_id, err)
+            return True
+
+        async def retry(file_id: int) -> None:
+            try:
+                await purge(file_id)
+            except Exception as err:
+                _LOGGER.debug("Trash purge of file %s still failing: %r", file_id, err)
+
+        results = await asyncio.gather(
+            *(delete(file_id) for file_id in file_ids),
+            *(retry(file_id) for file_id in retry_purge),
+        )
+        return [file_id for file_id, ok in zip(file_ids, results) if not ok]
+
+    async def download_file_stream(self, file_id: int, size: Optional[int] = None, transforms: Sequence[str] = ()) -> AsyncIterator[bytes]:
+        # `size` is the remote size; `transforms` are reverted on the fly
+        timer = TransferTimer("download", str(file_id))
+        success = False
+        stream = self._download_file_stream(file_id, size)
+        if transforms:
+            stream = revert_transforms(self._hass, stream, transforms, self._encryption_key)
+        try:
+            async for chunk in stream:
+                timer.bytes += len(chunk)
+                yield chunk
+            success = True
+        finally:
+            self.stats.record_transfer(timer, success)
+            _LOGGER.debug("Download of file %s %s: %s", file_id, "done" if success else "failed", timer.as_dict())
+
+    async def _download_file_stream(self, file_id: int, size: Optional[int]) -> AsyncIterator[bytes]:
         url = f"{self._base_v3}/files/{file_id}/download"
-        resp = await self._session.get(url, headers=self._headers)
-        resp.raise_for_status()
-        async for chunk in resp.content.iter_chunked(64 * 1024):
-            yield chunk
-
-    async def upload_stream_to_folder(self, *, filename: str, open_stream, size_hint: Optional[int] = None) -> None:
-        ONE_GIB = 900 * 1024 * 1024 # 900 MiB
-        chunk_size = 5 * 1024 * 1024  # 5 MiB
+        if size and self._download_concurrency > 1 and size > DOWNLOAD_RANGE_SIZE:
+            started = False
+            try:
+                async for chunk in self._download_ranges(url, size):
+                    started = True
+                    yield chunk
+                return
+            except _RangeNotSupported:
+                if started:
+                    raise
+        # Single stream: retried only until the first byte is handed out
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async with self._open("GET", url, endpoint="download") as resp:
+                    async for chunk in resp.content.iter_chunked(64 * 1024):
+                        started = True
+                        yield chunk
+                return
+            except Exception as err:
+                if started or not await self._retry_wait(err, attempt, REQUEST_RETRIES):
+                    raise
+                attempt += 1
+
+    async def _download_ranges(self, url: str, size: int) -> AsyncIterator[bytes]:
+        # Fetch up to `download_concurrency` ranges at once and yield them in
+        # order; memory stays bounded to the ranges in flight.
+        ranges = iter(
+            (start, min(start + DOWNLOAD_RANGE_SIZE, size) - 1)
+            for start in range(0, size, DOWNLOAD_RANGE_SIZE)
+        )
+        pending: Deque[asyncio.Task] = deque(
+            asyncio.create_task(self._fetch_range(url, start, end))
+            for start, end in itertools.islice(ranges, self._download_concurrency)
+        )
+        try:
+            while pending:
+                data = await pending.popleft()
+                nxt = next(ranges, None)
+                if nxt is not None:
+                    pending.append(asyncio.create_task(self._fetch_range(url, *nxt)))
+                yield data
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _fetch_range(self, url: str, start: int, end: int) -> bytes:
+        buf = bytearray()
+        attempt = 0
+        while True:
+            try:
+                # A retry resumes after the bytes already received
+                headers = {**self._headers, "Range": f"bytes={start + len(buf)}-{end}"}
+                async with self._open("GET", url, endpoint="download", headers=headers) as resp:
+                    if resp.status != 206:
+                        raise _RangeNotSupported(url)
+                    async for part in resp.content.iter_chunked(64 * 1024):
+                        buf += part
+                if len(buf) != end - start + 1:
+                    raise aiohttp.ClientPayloadError(f"Short range response for bytes={start}-{end}")
+                return bytes(buf)
+            except Exception as err:
+                if not await self._retry_wait(err, attempt, DOWNLOAD_RANGE_RETRIES):
+                    raise
+                attempt += 1
+
+    @property
+    def direct_upload_limit(self) -> int:
+        # Largest file sent in a single request. It cannot resume, so keep it
+        # to what the link sends in DIRECT_UPLOAD_MAX_TIME at the last
+        # measured speed.
+        speed = self.stats.upload_speed
+        if not speed:
+            return DIRECT_UPLOAD_DEFAULT_SIZE
+        return int(min(DIRECT_UPLOAD_MAX_SIZE, max(DIRECT_UPLOAD_MIN_SIZE, speed * DIRECT_UPLOAD_MAX_TIME)))
+
+    def transformed(self, open_stream, transforms: Sequence[str]):
+        # Wraps `open_stream` so the stream it opens has `transforms` applied
+        if not transforms:
+            return open_stream
+
+        async def open_transformed() -> AsyncIterator[bytes]:
+            return apply_transforms(self._hass, await open_stream(), transforms, self._encryption_key)
+        return open_transformed
+
+    async def upload_stream_to_folder(
+        self,
+        *,
+        filename: str,
+        open_stream,
+        size_hint: Optional[int] = None,
+        transforms: Sequence[str] = (),
+        on_progress: Optional[Callable[[int], None]] = None,
+        resumable: Optional[bool] = None,
+    ) -> Dict[str, Any]:
+        # `on_progress` receives the number of bytes stored so far. Returns
+        # the SHA-256 and size of the stored content and the file item.
+        # `resumable` must be False when the stream is not the same from one
+        # read to the next (encrypted with a fresh salt and nonces): the
+        # chunks acked by a previous attempt would not match the new ones.
+        if resumable is None:
+            resumable = XF_AESGCM not in transforms
+        if transforms:
+            open_stream = self.transformed(open_stream, transforms)
+            size_hint = None  # only known once transformed
         session_token = None
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=True)) as upload_session:
+        tmp_path = None
+        success = False
+        timer = TransferTimer("upload", filename)
+        upload_session = self._get_upload_session()
+
+        # ------------------------------------------------------------------
+        # 1) Determine the total size (unknown sizes go chunked)
+        # ------------------------------------------------------------------
+        total_size = size_hint
+
+        try:
+            # ------------------------------------------------------------------
+            # 2a) Direct upload, streamed, if small enough for the link and
+            #     no earlier attempt left a session to resume
+            # ------------------------------------------------------------------
+            if (
+                total_size is not None
+                and total_size <= self.direct_upload_limit
+                and not (resumable and await self._has_session(filename, total_size))
+            ):
+                params = {
+                    "total_size": total_size,
+                    "directory_id": self._folder_id,
+                    "file_name": filename,
+                }
+                headers = {**self._headers, "Content-Length": str(total_size)}
+                sha256_file = hashlib.sha256()
+                with timer.phase("direct_upload"):
+                    stream = self._count_stream(await open_stream(), total_size, sha256_file, on_progress)
+                    if self.limiter.enabled:
+                        stream = self.limiter.pace(stream)
+                    start = time.monotonic()
+                    data = await self._request("POST", f"{self._base_v3}/upload", endpoint="upload", session=upload_session, headers=headers, params=params, data=stream, read=_read_json)
+                    self.stats.record_upload_speed(total_size, time.monotonic() - start)
+                total_hash = sha256_file.hexdigest()
 
             # ------------------------------------------------------------------
-            # 1) Determine the total size
+            # 2b) Chunked upload, resumable
             # ------------------------------------------------------------------
-            if size_hint is None:
-                total_size = ONE_GIB + 1  # Force chunked upload
             else:
-                total_size = size_hint
-            
-            try:
-                # ------------------------------------------------------------------
-                # 2a) Direct upload if <= 1 Go (900 MiB in reality)
-                # ------------------------------------------------------------------
-                if total_size <= ONE_GIB:
-                    url = f"{self._base_v3}/upload?total_size={total_size}&directory_id={self._folder_id}&file_name={filename}"
-                    async with upload_session.post(url, headers=self._headers, data=await open_stream()
-                    ) as resp:
-                        resp.raise_for_status()
-
-                # ------------------------------------------------------------------
-                # 2b) Chunked upload if > 1 Go (900 MiB in reality)
-                # ------------------------------------------------------------------
-                else:
-                    # --- WRITE THE WHOLE STREAM TO DISK FIRST (no RAM buffering) --- #
-                    fd, tmp_path = tempfile.mkstemp(prefix="ha-kdrive-", suffix=".bin",  dir="/media")
-                    os.close(fd)
+                if size_hint is None:
+                    # --- UNKNOWN SIZE: WRITE THE WHOLE STREAM TO DISK FIRST --- #
+                    with timer.phase("spool"):
+                        fd, tmp_path = await self._hass.async_add_executor_job(
+                            partial(tempfile.mkstemp, prefix="ha-kdrive-", suffix=".bin", dir=SPOOL_DIR)
+                        )
+                        total_size = await self._spool(fd, await open_stream())
+
+                # --- START OR RESUME THE SESSION --- #
+                # kDrive may drop a session before the journal expires it: a
+                # resumed session it rejects is replaced by a new one, once
+                resumed = resumable and await self._has_session(filename, total_size)
+                while True:
+                    with timer.phase("session_start"):
+                        session = await self._open_upload_session(upload_session, filename, total_size, resumable)
+                    session_token = session["token"]
+                    chunk_size = session["chunk_size"]
+                    if tmp_path:
+                        chunks = self._read_chunks(tmp_path, chunk_size)
+                    else:
+                        # --- STREAM THE CHUNKS STRAIGHT FROM THE BACKUP --- #
+                        chunks = _rechunk(await open_stream(), chunk_size, total_size)
+
                     try:
-                        with open(tmp_path, "ab") as f:
-                            async for part in await open_stream():
-                                f.write(part)
-                        total_size = os.path.getsize(tmp_path)
-                    except Exception:
-                        try:
-                            os.remove(tmp_path)
-                        except OSError:
-                            pass
-                        raise
-                                        
-                    # --- START SESSION --- #
-                    url = f"{self._base_v3}/upload/session/start"
-                    payload = {
-                        "directory_id": self._folder_id,
-                        "file_name": filename,
-                        "total_size": total_size,
-                        "total_chunks": math.ceil(total_size / chunk_size),
-                    }
-                    async with upload_session.post(url, headers={**self._headers, "Content-Type": "application/json"}, json=payload
-                    ) as resp:
-                        resp.raise_for_status()
-                        data = await resp.json()
-
-                    # --- EXTRACT SESSION TOKEN & URL UPLOAD --- #
-                    session_token = data.get("data", {}).get("token")
-                    upload_url_session = data.get("data", {}).get("upload_url")                    
-                    if not session_token:
-                        raise RuntimeError("Session token manquant")
-                    
-                    # --- READ THE FILE BY CHUNKS & CALCULATE THE SHA256 --- #
-                    sha256_file = hashlib.sha256()
-                    async def chunk_iter():
-                        with open(tmp_path, "rb") as f:
-                            while True:
-                                buf = f.read(chunk_size)
-                                sha256_file.update(buf)
-                                if not buf:
-                                    break
-                                yield buf
-                    
-                    # --- LOOK TO UPLOAD EACH CHUNK --- #
-                    iteration = 0
-                    async for chunk in chunk_iter():
-                        iteration += 1
-                        url = f"{upload_url_session}/3/drive/{self._drive_id}/upload/session/{session_token}/chunk"                        
+                        # --- UPLOAD THE CHUNKS, SEVERAL IN FLIGHT --- #
+                        with timer.phase("chunks"):
+                            total_hash = await self._upload_chunks(
+                                upload_session,
+                                session["upload_url"],
+                                session_token,
+                                chunks,
+                                chunk_size,
+                                acked=set(session["acked"]),
+                                on_ack=lambda number: self._journal.mark_acked(filename, number),
+                                timer=timer,
+                                on_progress=on_progress,
+                            )
+
+                        # --- CLOSE THE SESSION --- #
+                        url = f"{self._base_v3}/upload/session/{session_token}/finish"
                         params = {
-                            "chunk_number": iteration,
-                            "chunk_size": len(chunk),
-                            "chunk_hash": f"sha256:{hashlib.sha256(chunk).hexdigest()}",
+                            "total_chunk_hash": f"sha256:{total_hash}",
+                            "with": "capabilities,supported_by,conversion_capabilities,users,teams,path,parents,parents.capabilities,parents.users,parents.teams,parents.path",
                         }
-                        async with upload_session.post(url, headers=self._headers, params=params, data=chunk
-                        ) as resp:
-                            resp.raise_for_status()
-                            data = await resp.json()
-                    
-                    try:
-                        os.remove(tmp_path)
-                    except OSError:
-                        pass
-                  
-                    # --- CLOSE THE SESSION --- #
-                    url = f"{self._base_v3}/upload/session/{session_token}/finish?with=capabilities,supported_by,conversion_capabilities,users,teams,path,parents,parents.capabilities,parents.users,parents.teams,parents.path"
-                    params = {
-                        "total_chunk_hash": f"sha256:{sha256_file.hexdigest()}",
-                    }
-                    async with upload_session.post(url, headers=self._headers, params=params,
-                    ) as resp: 
-                       resp.raise_for_status()
-                       data = await resp.json()
-
-            # --- CANCEL THE SESSION --- #
-            except Exception:
-                if session_token:
-                    cancel_url = f"{self._base_v2}/upload/session/{session_token}"
-                    try:
-                        async with upload_session.delete(
-                            cancel_url, headers=self._headers
-                        ):
-                          pass
-                    except Exception:
-                        pass
-                raise
-            
-            # --- REMOVE THE BACKUP FILE IN MEDIA FOLDER --- #
+                        with timer.phase("finish"):
+                            data = await self._request("POST", url, endpoint="session", session=upload_session, params=params, read=_read_json)
+                    except aiohttp.ClientResponseError as err:
+                        if not (resumed and 400 <= err.status < 500):
+                            raise
+                        _LOGGER.info("%s: upload session was rejected (%s), starting a new one", filename, err.status)
+                        await self._cancel_upload_session(upload_session, session_token)
+                        await self._journal.async_remove(filename)
+                        session_token = None
+                        resumed = False
+                        continue
+                    break
+                await self._journal.async_remove(filename)
+
+            # --- COMPARE WITH THE SERVER'S HASH, WHEN IT REPORTS ONE --- #
+            # The file is kept either way: the index records what was sent,
+            # so the next verification reports it as not matching its upload
+            result = (data or {}).get("data") or {}
+            item = result.get("file", result)
+            remote_hash = self.remote_sha256(item)
+            if remote_hash is not None and remote_hash != total_hash:
+                _LOGGER.warning("%s: stored SHA-256 %s does not match the uploaded %s", filename, remote_hash, total_hash)
+            timer.bytes = total_size
+            success = True
+            return {"sha256": total_hash, "size": total_size, "file": item}
+
+        # --- CANCEL THE SESSION, UNLESS IT CAN BE RESUMED --- #
+        except Exception as err:
+            if session_token:
+                if resumable and _is_transient(err):
+                    await self._journal.async_flush()
+                else:
+                    await self._cancel_upload_session(upload_session, session_token)
+                    await self._journal.async_remove(filename)
+            raise
+        
+        # --- REMOVE THE BACKUP FILE IN MEDIA FOLDER --- #
+        finally:
+            self.stats.record_transfer(timer, success)
+            _LOGGER.debug("Upload of %s %s: %s", filename, "done" if success else "failed", timer.as_dict())
+            if tmp_path:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    async def _count_stream(
+        self,
+        stream: AsyncIterator[bytes],
+        total_size: int,
+        sha256_file,
+        on_progress: Optional[Callable[[int], None]],
+    ) -> AsyncIterator[bytes]:
+        # Body of a direct upload: checks the announced size, hashes the
+        # content (in the executor) and reports the bytes handed to the
+        # connection
+        sent = 0
+        async for part in stream:
+            sent += len(part)
+            if sent > total_size:
+                raise RuntimeError(f"Backup stream larger than announced ({total_size} bytes)")
+            await self._hass.async_add_executor_job(sha256_file.update, part)
+            yield part
+            if on_progress is not None:
+                on_progress(sent)
+        if sent != total_size:
+            raise RuntimeError(f"Backup stream size mismatch: {sent} != {total_size}")
+
+    @staticmethod
+    def remote_sha256(item: Dict) -> Optional[str]:
+        # SHA-256 the API reports for a file item ("sha256:<hex>"), None when
+        # it reports none or tags the hash with another algorithm
+        value = item.get("hash") if isinstance(item, dict) else None
+        if not isinstance(value, str):
+            return None
+        algo, _, digest = value.partition(":")
+        if algo.lower() != "sha256" or len(digest) != 64:
+            return None
+        return digest.lower()
+
+    async def _spool(self, fd: int, stream: AsyncIterator[bytes]) -> int:
+        # Disk writes run in the executor, batched to limit the hand-offs
+        f = await self._hass.async_add_executor_job(os.fdopen, fd, "wb")
+        total = 0
+        try:
+            buf = bytearray()
+            async for part in stream:
+                buf += part
+                total += len(part)
+                if len(buf) >= SPOOL_WRITE_SIZE:
+                    data, buf = buf, bytearray()
+                    await self._hass.async_add_executor_job(f.write, data)
+            if buf:
+                await self._hass.async_add_executor_job(f.write, buf)
+        finally:
+            await self._hass.async_add_executor_job(f.close)
+        return total
+
+    async def _read_chunks(self, path: str, chunk_size: int) -> AsyncIterator[bytes]:
+        f = await self._hass.async_add_executor_job(open, path, "rb")
+        try:
+            while True:
+                buf = await self._hass.async_add_executor_job(f.read, chunk_size)
+                if not buf:
+                    break
+                yield buf
+        finally:
+            await self._hass.async_add_executor_job(f.close)
+
+    async def _has_session(self, filename: str, total_size: int) -> bool:
+        entry = await self._journal.async_get(filename)
+        return entry is not None and UploadJournal.is_resumable(entry, total_size)
+
+    async def _open_upload_session(self, upload_session: aiohttp.ClientSession, filename: str, total_size: int, resumable: bool = True) -> Dict:
+        await self.async_cancel_expired_sessions()
+        entry = await self._journal.async_get(filename)
+        if entry is not None:
+            if resumable and UploadJournal.is_resumable(entry, total_size):
+                return entry
+            await self._cancel_upload_session(upload_session, entry["token"])
+            await self._journal.async_remove(filename)
+
+        chunk_size = _pick_chunk_size(total_size)
+        url = f"{self._base_v3}/upload/session/start"
+        payload = {
+            "directory_id": self._folder_id,
+            "file_name": filename,
+            "total_size": total_size,
+            "total_chunks": math.ceil(total_size / chunk_size),
+        }
+        data = await self._request(
+            "POST", url, endpoint="session", session=upload_session,
+            headers={**self._headers, "Content-Type": "application/json"}, json=payload, read=_read_json,
+        )
+
+        # --- EXTRACT SESSION TOKEN & URL UPLOAD --- #
+        session_token = data.get("data", {}).get("token")
+        upload_url_session = data.get("data", {}).get("upload_url")
+        if not session_token:
+            raise RuntimeError("Session token manquant")
+        return await self._journal.async_start(
+            filename,
+            token=session_token,
+            upload_url=upload_url_session,
+            chunk_size=chunk_size,
+            total_size=total_size,
+        )
+
+    async def async_cancel_expired_sessions(self) -> None:
+        # Upload sessions left in the journal by uploads that were not retried
+        expired = await self._journal.async_prune()
+        if not expired:
+            return
+        upload_session = self._get_upload_session()
+        for entry in expired:
+            await self._cancel_upload_session(upload_session, entry["token"])
+        _LOGGER.debug("Cancelled %d expired upload session(s)", len(expired))
+
+    async def _cancel_upload_session(self, upload_session: aiohttp.ClientSession, session_token: str) -> None:
+        cancel_url = f"{self._base_v2}/upload/session/{session_token}"
+        try:
+            await self._request("DELETE", cancel_url, endpoint="session", session=upload_session, retries=0)
+        except Exception:
+            pass
+
+    async def _upload_chunks(
+        self,
+        upload_session: aiohttp.ClientSession,
+        upload_url: str,
+        session_token: str,
+        chunks: AsyncIterator[bytes],
+        chunk_size: int,
+        acked: Set[int],
+        on_ack: Callable[[int], None],
+        timer: TransferTimer,
+        on_progress: Optional[Callable[[int], None]] = None,
+    ) -> str:
+        # Chunks are read and hashed in order (in the executor), only the POSTs
+        # overlap: at most `upload_concurrency` in flight, fewer when their
+        # chunks would hold more than UPLOAD_MAX_BUFFER bytes. Chunks in
+        # `acked` were stored by a previous attempt and are only hashed.
+        # Returns the SHA-256 of the whole content.
+        url = f"{upload_url}/3/drive/{self._drive_id}/upload/session/{session_token}/chunk"
+        sha256_file = hashlib.sha256()
+        window = asyncio.Semaphore(max(1, min(self._upload_concurrency, UPLOAD_MAX_BUFFER // chunk_size)))
+        in_flight: set[asyncio.Task] = set()
+        stored = 0
+
+        def progress(size: int) -> None:
+            nonlocal stored
+            stored += size
+            if on_progress is not None:
+                on_progress(stored)
+
+        async def send(number: int, chunk: bytes, chunk_hash: str) -> None:
+            try:
+                params = {
+                    "chunk_number": number,
+                    "chunk_size": len(chunk),
+                    "chunk_hash": f"sha256:{chunk_hash}",
+                }
+                start = time.monotonic()
+                await self._request(
+                    "POST", url, endpoint="upload", session=upload_session, params=params,
+                    data=chunk, paced=True, read=_read_bytes, retries=UPLOAD_CHUNK_RETRIES, timer=timer,
+                )
+                duration = time.monotonic() - start
+                timer.chunk_durations.append(duration)
+                self.stats.record_upload_speed(len(chunk), duration)
+                on_ack(number)
+                progress(len(chunk))
             finally:
-                if tmp_path:
-                    try:
-                        os.remove(tmp_path)
-                    except OSError:
-                        pass
+                window.release()
+
+        try:
+            number = 0
+            async for chunk in chunks:
+                number += 1
+                if number in acked:
+                    await self._hass.async_add_executor_job(sha256_file.update, chunk)
+                    progress(len(chunk))
+                    continue
+                chunk_hash = await self._hass.async_add_executor_job(_hash_chunk, sha256_file, chunk)
+                await window.acquire()
+                # Surface a failed chunk before queuing more work
+                for task in [t for t in in_flight if t.done()]:
+                    in_flight.discard(task)
+                    task.result()
+                in_flight.add(asyncio.create_task(send(number, chunk, chunk_hash)))
+            await asyncio.gather(*in_flight)
+        except BaseException:
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+            raise
+        return sha256_file.hexdigest()
+
+
+async def _rechunk(stream: AsyncIterator[bytes], chunk_size: int, total_size: int) -> AsyncIterator[bytes]:
+    # Slice the backup stream into exact chunk_size pieces; only the pending
+    # chunk is buffered here, the in-flight ones are bounded by the window.
+    buf = bytearray()
+    received = 0
+    async for part in stream:
+        received += len(part)
+        if received > total_size:
+            raise RuntimeError(f"Backup stream larger than announced ({total_size} bytes)")
+        buf += part
+        while len(buf) >= chunk_size:
+            yield bytes(buf[:chunk_size])
+            del buf[:chunk_size]
+    if received != total_size:
+        raise RuntimeError(f"Backup stream size mismatch: {received} != {total_size}")
+    if buf:
+        yield bytes(buf)
+
+
+def _hash_chunk(total, chunk: bytes) -> str:
+    # Runs in the executor: feeds the whole-file hash and returns the chunk hash
+    total.update(chunk)
+    return hashlib.sha256(chunk).hexdigest()
+
+
+class _RangeNotSupported(Exception):
+    pass
+
+
+class _CircuitBreaker:
+    # Trips after CIRCUIT_FAILURE_THRESHOLD consecutive transient failures.
+    # Requests then wait CIRCUIT_OPEN_TIME, after which a single probe
+    # decides whether traffic resumes or the circuit opens again.
+
+    def __init__(self) -> None:
+        self._failures = 0
+        self._open_until = 0.0
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._failures >= CIRCUIT_FAILURE_THRESHOLD
+
+    async def wait(self) -> None:
+        while self.is_open:
+            delay = self._open_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif self._probing:
+                await asyncio.sleep(1)
+            else:
+                self._probing = True
+                return
+
+    def record(self, healthy: Optional[bool]) -> None:
+        # None: the request was abandoned (cancelled) before an outcome
+        self._probing = False
+        if healthy:
+            self._failures = 0
+        elif healthy is not None:
+            self._failures += 1
+            if self.is_open:
+                self._open_until = time.monotonic() + CIRCUIT_OPEN_TIME
+                _LOGGER.warning("kDrive API failing, pausing requests for %ds", CIRCUIT_OPEN_TIME)
+
+
+async def _read_json(resp: aiohttp.ClientResponse) -> Any:
+    return await resp.json()
+
+
+async def _read_bytes(resp: aiohttp.ClientResponse) -> bytes:
+    return await resp.read()
+
+
+async def _read_size(resp: aiohttp.ClientResponse) -> Optional[int]:
+    if resp.status == 206:
+        return _parse_int(resp.headers.get("Content-Range", "").rpartition("/")[2])
+    return _parse_int(resp.headers.get("Content-Length"))
+
+
+def _parse_int(value: Optional[str]) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _is_transient(err: BaseException) -> bool:
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status in (408, 429) or err.status >= 500
+    return isinstance(err, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def _retry_delay(err: BaseException, attempt: int) -> float:
+    # Retry-After when the server sent one, else exponential backoff with
+    # jitter so parallel requests do not retry in lockstep
+    headers = getattr(err, "headers", None)
+    retry_after = _parse_retry_after(headers.get("Retry-After")) if headers else None
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_DELAY)
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # Either delay-seconds or an HTTP date
+    if not value:
+        return None
+    seconds = _parse_int(value.strip())
+    if seconds is not None:
+        return max(0, seconds)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt_util.UTC)
+    return max(0.0, (when - dt_util.utcnow()).total_seconds())
+
+
+def _pick_chunk_size(total_size: int) -> int:
+    # Bigger files get bigger chunks to keep the number of round trips low
+    chunk_size = UPLOAD_CHUNK_SIZE
+    while chunk_size < UPLOAD_MAX_CHUNK_SIZE and math.ceil(total_size / chunk_size) > UPLOAD_TARGET_CHUNKS:
+        chunk_size *= 2
+    return min(chunk_size, UPLOAD_MAX_CHUNK_SIZE)
@@ -2,12 +2,41 @@
 from __future__ import annotations
 import voluptuous as vol
 from homeassistant import config_entries
+from homeassistant.core import callback
 from homeassistant.helpers import config_entry_oauth2_flow
 
-from .const import DOMAIN, CONF_TOKEN, CONF_FOLDER_URL, CONF_DRIVE_ID, CONF_FOLDER_ID, parse_kdrive_folder_url
+from .const import (
+    DOMAIN,
+    CONF_TOKEN,
+    CONF_FOLDER_URL,
+    CONF_DRIVE_ID,
+    CONF_FOLDER_ID,
+    CONF_UPLOAD_CONCURRENCY,
+    CONF_DOWNLOAD_CONCURRENCY,
+    CONF_KEEP_DAILY,
+    CONF_KEEP_WEEKLY,
+    CONF_KEEP_MONTHLY,
+    CONF_MAX_TOTAL_SIZE,
+    CONF_COMPRESSION,
+    CONF_ENCRYPTION_KEY,
+    CONF_INCREMENTAL,
+    CONF_BANDWIDTH_LIMIT,
+    CONF_BANDWIDTH_SCHEDULE,
+    CONF_MIRROR_FOLDER_URL,
+    DEFAULT_UPLOAD_CONCURRENCY,
+    DEFAULT_DOWNLOAD_CONCURRENCY,
+    parse_kdrive_folder_url,
+)
+from .throttle import parse_schedule
 
 class InforaniakKDriveConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
     VERSION = 5
+    MINOR_VERSION = 2  # 2: per-entry backup agents
+
+    @staticmethod
+    @callback
+    def async_get_options_flow(config_entry: config_entries.ConfigEntry) -> KDriveOptionsFlow:
+        return KDriveOptionsFlow()
 
     async def async_step_user(self, user_input=None):
         implementations = await config_entry_oauth2_flow.async_get_implementations(self.hass, DOMAIN)
@@ -35,3 +64,40 @@ class InforaniakKDriveConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             self._abort_if_unique_id_configured()
             return self.async_create_entry(title=f"kDrive {uid}", data=data)
         return self.async_show_form(step_id="manual", data_schema=schema, description_placeholders=description_placeholders)
+
+
+class KDriveOptionsFlow(config_entries.OptionsFlow):
+    async def async_step_init(self, user_input=None):
+        errors = {}
+        if user_input is not None:
+            try:
+                parse_schedule(user_input.get(CONF_BANDWIDTH_SCHEDULE, ""))
+            except ValueError:
+                errors["base"] = "invalid_bandwidth_schedule"
+            mirror_url = user_input.get(CONF_MIRROR_FOLDER_URL)
+            if mirror_url:
+                try:
+                    mirror = parse_kdrive_folder_url(mirror_url)
+                except ValueError:
+                    errors["base"] = "invalid_folder_url"
+                else:
+                    if mirror == (self.config_entry.data[CONF_DRIVE_ID], self.config_entry.data[CONF_FOLDER_ID]):
+                        errors["base"] = "mirror_same_folder"
+            if not errors:
+                return self.async_create_entry(data=user_input)
+        options = user_input or self.config_entry.options
+        schema = vol.Schema({
+            vol.Optional(CONF_UPLOAD_CONCURRENCY, default=options.get(CONF_UPLOAD_CONCURRENCY, DEFAULT_UPLOAD_CONCURRENCY)): vol.All(vol.Coerce(int), vol.Range(min=1, max=16)),
+            vol.Optional(CONF_DOWNLOAD_CONCURRENCY, default=options.get(CONF_DOWNLOAD_CONCURRENCY, DEFAULT_DOWNLOAD_CONCURRENCY)): vol.All(vol.Coerce(int), vol.Range(min=1, max=16)),
+            vol.Optional(CONF_KEEP_DAILY, default=options.get(CONF_KEEP_DAILY, 0)): vol.All(vol.Coerce(int), vol.Range(min=0)),
+            vol.Optional(CONF_KEEP_WEEKLY, default=options.get(CONF_KEEP_WEEKLY, 0)): vol.All(vol.Coerce(int), vol.Range(min=0)),
+            vol.Optional(CONF_KEEP_MONTHLY, default=options.get(CONF_KEEP_MONTHLY, 0)): vol.All(vol.Coerce(int), vol.Range(min=0)),
+            vol.Optional(CONF_MAX_TOTAL_SIZE, default=options.get(CONF_MAX_TOTAL_SIZE, 0)): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Optional(CONF_COMPRESSION, default=options.get(CONF_COMPRESSION, False)): bool,
+            vol.Optional(CONF_INCREMENTAL, default=options.get(CONF_INCREMENTAL, False)): bool,
+            vol.Optional(CONF_ENCRYPTION_KEY, description={"suggested_value": options.get(CONF_ENCRYPTION_KEY)}): str,
+            vol.Optional(CONF_BANDWIDTH_LIMIT, default=options.get(CONF_BANDWIDTH_LIMIT, 0)): vol.All(vol.Coerce(int), vol.Range(min=0)),
+            vol.Optional(CONF_BANDWIDTH_SCHEDULE, description={"suggested_value": options.get(CONF_BANDWIDTH_SCHEDULE)}): str,
+            vol.Optional(CONF_MIRROR_FOLDER_URL, description={"suggested_value": options.get(CONF_MIRROR_FOLDER_URL)}): str,
+        })
+        return self.async_show_form(step_id="init", data_schema=schema, errors=errors)
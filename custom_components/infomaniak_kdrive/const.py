@@ -3,20 +3,128 @@ from __future__ import annotations
 import re
 
 DOMAIN = "infomaniak_kdrive"
+API_URL = "https://api.infomaniak.com"
 
 CONF_TOKEN = "token"
 CONF_DRIVE_ID = "drive_id"
 CONF_FOLDER_ID = "folder_id"
 CONF_FOLDER_URL = "folder_url"
+CONF_UPLOAD_CONCURRENCY = "upload_concurrency"
+CONF_DOWNLOAD_CONCURRENCY = "download_concurrency"
+CONF_KEEP_DAILY = "keep_daily"
+CONF_KEEP_WEEKLY = "keep_weekly"
+CONF_KEEP_MONTHLY = "keep_monthly"
+CONF_MAX_TOTAL_SIZE = "max_total_size"  # GiB, 0 = unlimited
+CONF_COMPRESSION = "compression"
+CONF_ENCRYPTION_KEY = "encryption_key"
+CONF_INCREMENTAL = "incremental"
+CONF_BANDWIDTH_LIMIT = "bandwidth_limit"  # KiB/s, 0 = unlimited
+CONF_BANDWIDTH_SCHEDULE = "bandwidth_schedule"  # "HH:MM-HH:MM=KiB/s, ..."
+CONF_MIRROR_FOLDER_URL = "mirror_folder_url"  # second folder every upload is copied to
+CONF_AGENT_ID = "agent_id"  # entry data, backup agent id kept from the single-agent releases
 
+# hass.data[DOMAIN][entry_id] keys
 DATA_CLIENT = "client"
+DATA_MIRROR = "mirror"  # client of the mirror folder, if any
+DATA_CATALOG = "catalog"
+DATA_ENTRY = "entry"
+DATA_INDEX = "index"
+DATA_CHUNK_STORE = "chunk_store"
+DATA_OPTIONS = "options"  # options the client was built with
+# Options read on use or applied live, changing them needs no reload
+LIVE_OPTIONS = {
+    CONF_KEEP_DAILY,
+    CONF_KEEP_WEEKLY,
+    CONF_KEEP_MONTHLY,
+    CONF_MAX_TOTAL_SIZE,
+    CONF_INCREMENTAL,
+    CONF_BANDWIDTH_LIMIT,
+    CONF_BANDWIDTH_SCHEDULE,
+}
+
 DATA_BACKUP_AGENT_LISTENERS = "backup_agent_listeners"
 
 AGENT_NAME = "Infomaniak kDrive"
+LEGACY_AGENT_ID = "infomaniak_kdrive_default"  # agent id before one agent per entry
 
 ID_TAG = "__id-"
 VER_TAG = "__ver-"
 PROT_TAG = "__prot-"
+XF_TAG = "__xf-"  # client-side transforms, in the order they were applied
+
+INDEX_FILENAME = ".ha_kdrive_index.json"
+
+# Date suffix written by suggested_filename_from_name_date: _YYYY-MM-DD_HH.MM_SSffffff
+FILENAME_DATE_RE = re.compile(r"_(\d{4})-(\d{2})-(\d{2})_(\d{2})\.(\d{2})_(\d{2})(\d{6})$")
+
+CATALOG_TTL = 60  # seconds
+CATALOG_STORE_VERSION = 1
+CATALOG_SAVE_DELAY = 10  # seconds
+LIST_PAGE_SIZE = 1000  # max allowed by the v3 listing endpoint
+SIZE_LOOKUP_CONCURRENCY = 8
+DELETE_CONCURRENCY = 4
+
+# Chunked upload tuning
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024  # 5 MiB, smallest chunk
+UPLOAD_MAX_CHUNK_SIZE = 100 * 1024 * 1024  # 100 MiB
+UPLOAD_TARGET_CHUNKS = 500  # grow the chunks above this count
+DEFAULT_UPLOAD_CONCURRENCY = 4
+UPLOAD_MAX_BUFFER = 256 * 1024 * 1024  # chunk bytes held by in-flight POSTs
+UPLOAD_DNS_CACHE_TTL = 300  # seconds
+UPLOAD_KEEPALIVE_TIMEOUT = 60  # seconds
+UPLOAD_CONNECT_TIMEOUT = 30  # seconds
+UPLOAD_READ_TIMEOUT = 300  # seconds, kDrive may take a while to ack a chunk
+# Single-request uploads cannot resume, keep them to what the link sends in
+# DIRECT_UPLOAD_MAX_TIME at the measured speed
+DIRECT_UPLOAD_MAX_SIZE = 900 * 1024 * 1024  # API limit is 1 GB
+DIRECT_UPLOAD_MIN_SIZE = 16 * 1024 * 1024
+DIRECT_UPLOAD_DEFAULT_SIZE = 100 * 1024 * 1024  # until a speed is measured
+DIRECT_UPLOAD_MAX_TIME = 120  # seconds
+SPOOL_DIR = "/media"  # backups of unknown size are written here first
+SPOOL_WRITE_SIZE = 4 * 1024 * 1024  # batch spool writes handed to the executor
+UPLOAD_CHUNK_RETRIES = 4
+RETRY_BASE_DELAY = 2  # seconds, doubled on each retry
+
+# Request layer (every API call)
+REQUEST_RETRIES = 4
+RETRY_MAX_DELAY = 60  # seconds, also caps Retry-After
+CIRCUIT_FAILURE_THRESHOLD = 5  # consecutive transient failures
+CIRCUIT_OPEN_TIME = 30  # seconds without requests once tripped
+LIST_CONCURRENCY = 2
+SESSION_CONCURRENCY = 2  # upload session start/finish/cancel
+
+# Ranged downloads (restore)
+DEFAULT_DOWNLOAD_CONCURRENCY = 4  # 1 disables ranged downloads
+DOWNLOAD_RANGE_SIZE = 8 * 1024 * 1024  # 8 MiB
+DOWNLOAD_RANGE_RETRIES = 4
+
+# Client-side transforms (unprotected backups only)
+XF_ZSTD = "zstd"
+XF_AESGCM = "aesgcm"
+XF_CDC = "cdc"  # the file is a recipe of deduplicated chunks
+TRANSFORM_BLOCK_SIZE = 1024 * 1024  # 1 MiB
+TRANSFORM_ZSTD_LEVEL = 3
+
+# Incremental (deduplicated) backups
+CHUNK_STORE_FOLDER = ".ha_kdrive_chunks"
+CHUNK_INDEX_VERSION = 1
+CDC_MIN_SIZE = 1024 * 1024  # 1 MiB
+CDC_MAX_SIZE = 8 * 1024 * 1024  # 8 MiB
+CDC_MARKER = b"\x8f\x3a"  # ~every 64 KiB in random data past the minimum
+
+# Mirrored uploads: parts the fastest upload may run ahead of the slowest
+TEE_QUEUE_SIZE = 64
+
+# Bandwidth shaping
+THROTTLE_SLICE_SIZE = 64 * 1024
+
+# Periodic integrity check of the stored backups (listing only)
+VERIFY_INTERVAL = 24 * 3600  # seconds
+
+# Upload session journal (resumable uploads)
+UPLOAD_JOURNAL_VERSION = 1
+UPLOAD_JOURNAL_SAVE_DELAY = 5  # seconds
+UPLOAD_SESSION_MAX_AGE = 24 * 3600  # seconds
 
 OAUTH2_AUTHORIZE = "https://login.infomaniak.com/authorize"
 OAUTH2_TOKEN = "https://login.infomaniak.com/token"
@@ -0,0 +1,217 @@
+
+from __future__ import annotations
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, List, Optional, Set
+
+import aiohttp
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+from .client import KDriveClient
+from .const import (
+    CDC_MARKER,
+    CDC_MAX_SIZE,
+    CDC_MIN_SIZE,
+    CHUNK_INDEX_VERSION,
+    CHUNK_STORE_FOLDER,
+)
+
+_LOGGER = logging.getLogger(__name__)
+
+async def split_content_defined(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Cut after the first CDC_MARKER found past CDC_MIN_SIZE (or at
+    # CDC_MAX_SIZE). Boundaries depend on the content only, so an insertion
+    # early in the archive does not shift every later chunk. The marker search
+    # is bytes.find, which keeps this at C speed.
+    buf = bytearray()
+    async for part in stream:
+        buf += part
+        while len(buf) >= CDC_MIN_SIZE:
+            pos = buf.find(CDC_MARKER, CDC_MIN_SIZE, CDC_MAX_SIZE)
+            if pos < 0:
+                if len(buf) < CDC_MAX_SIZE:
+                    break
+                cut = CDC_MAX_SIZE
+            else:
+                cut = pos + len(CDC_MARKER)
+            yield bytes(buf[:cut])
+            del buf[:cut]
+    if buf:
+        yield bytes(buf)
+
+
+def _hash_chunk(total, chunk: bytes) -> str:
+    total.update(chunk)
+    return hashlib.sha256(chunk).hexdigest()
+
+
+def _sha256_hex(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class ChunkStore:
+    # Content-addressed chunks in a sub folder of the backup folder, one file
+    # per SHA-256. A backup is stored as a small recipe listing its chunks.
+    # The hash -> file id map is kept locally so restores need no listing.
+
+    def __init__(self, hass: HomeAssistant, client: KDriveClient, key: str) -> None:
+        self._hass = hass
+        self._client = client
+        self._store: Store = Store(hass, CHUNK_INDEX_VERSION, key)
+        self._chunks: Optional[Dict[str, Optional[int]]] = None
+        self._folder_id: Optional[int] = None
+        # Uploads and garbage collection must not interleave
+        self._lock = asyncio.Lock()
+
+    async def _async_load(self) -> Dict[str, Optional[int]]:
+        if self._chunks is None:
+            data = await self._store.async_load() or {}
+            self._folder_id = data.get("folder_id")
+            self._chunks = data.get("chunks", {})
+        return self._chunks
+
+    def _data(self) -> dict:
+        return {"folder_id": self._folder_id, "chunks": self._chunks or {}}
+
+    async def _async_folder_id(self) -> int:
+        await self._async_load()
+        if self._folder_id is None:
+            async for it in self._client.iter_folder_files(types=("dir",)):
+                if it.get("name") == CHUNK_STORE_FOLDER:
+                    self._folder_id = it["id"]
+                    break
+            else:
+                self._folder_id = (await self._client.create_directory(CHUNK_STORE_FOLDER))["id"]
+        return self._folder_id
+
+    async def _async_refresh(self) -> None:
+        # The remote folder is authoritative (chunks may have been removed)
+        folder_id = await self._async_folder_id()
+        try:
+            self._chunks = {
+                it["name"]: it["id"] async for it in self._client.iter_folder_files(folder_id)
+            }
+        except aiohttp.ClientResponseError as err:
+            if err.status != 404:
+                raise
+            # The chunk folder was removed remotely, start a new one
+            self._folder_id = None
+            await self._async_folder_id()
+            self._chunks = {}
+        await self._store.async_save(self._data())
+
+    async def async_upload(self, stream: AsyncIterator[bytes], filename: str) -> Dict[str, Any]:
+        # Uploads the chunks not stored yet, then the recipe as `filename`.
+        # Both happen under the lock, so a garbage collection never sees the
+        # chunks without the recipe referring to them. Returns the SHA-256 and
+        # size of the recipe file and the file item.
+        async with self._lock:
+            await self._async_refresh()
+            folder_id = self._folder_id
+            chunks = self._chunks
+            total = hashlib.sha256()
+            recipe: List[List[Any]] = []
+            queued: Set[str] = set()
+            window = asyncio.Semaphore(self._client.upload_concurrency)
+            in_flight: Set[asyncio.Task] = set()
+            uploaded = 0
+
+            async def send(digest: str, chunk: bytes) -> None:
+                try:
+                    item = await self._client.upload_bytes(digest, chunk, conflict="version", directory_id=folder_id)
+                    chunks[digest] = item.get("id")
+                finally:
+                    window.release()
+
+            try:
+                async for chunk in split_content_defined(stream):
+                    digest = await self._hass.async_add_executor_job(_hash_chunk, total, chunk)
+                    recipe.append([digest, len(chunk)])
+                    if digest in chunks or digest in queued:
+                        continue
+                    queued.add(digest)
+                    uploaded += len(chunk)
+                    await window.acquire()
+                    for task in [t for t in in_flight if t.done()]:
+                        in_flight.discard(task)
+                        task.result()
+                    in_flight.add(asyncio.create_task(send(digest, chunk)))
+                await asyncio.gather(*in_flight)
+            except BaseException:
+                for task in in_flight:
+                    task.cancel()
+                await asyncio.gather(*in_flight, return_exceptions=True)
+                raise
+            finally:
+                await self._store.async_save(self._data())
+
+            size = sum(length for _, length in recipe)
+            _LOGGER.debug("Incremental upload: %d chunks, %d of %d bytes sent", len(recipe), uploaded, size)
+            payload = json.dumps(
+                {"version": 1, "size": size, "sha256": total.hexdigest(), "chunks": recipe},
+                separators=(",", ":"),
+            ).encode()
+            # Replaced in a single upload, like the index: uploading the same
+            # backup again, or a retried POST the server did complete, succeeds
+            item = await self._client.upload_bytes(filename, payload, conflict="version")
+            return {"sha256": _sha256_hex(payload), "size": len(payload), "file": item}
+
+    async def async_download(self, recipe_file_id: int) -> AsyncIterator[bytes]:
+        # Streams the archive back, fetching a few chunks ahead and checking
+        # each one against its hash
+        recipe = json.loads(await self._client.download_bytes(recipe_file_id))
+        chunks = await self._async_load()
+        if any(chunks.get(digest) is None for digest, _ in recipe["chunks"]):
+            await self._async_refresh()
+            chunks = self._chunks
+
+        async def fetch(digest: str) -> bytes:
+            file_id = chunks.get(digest)
+            if file_id is None:
+                raise FileNotFoundError(f"Missing chunk {digest}")
+            data = await self._client.download_bytes(file_id)
+            if await self._hass.async_add_executor_job(_sha256_hex, data) != digest:
+                raise ValueError(f"Corrupted chunk {digest}")
+            return data
+
+        digests = iter(digest for digest, _ in recipe["chunks"])
+        pending: Deque[asyncio.Task] = deque(
+            asyncio.create_task(fetch(digest))
+            for digest in itertools.islice(digests, self._client.upload_concurrency)
+        )
+        try:
+            while pending:
+                data = await pending.popleft()
+                digest = next(digests, None)
+                if digest is not None:
+                    pending.append(asyncio.create_task(fetch(digest)))
+                yield data
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def async_collect_garbage(self, list_recipes: Callable[[], Awaitable[Iterable[int]]]) -> None:
+        # Deletes the chunks no remaining recipe refers to. `list_recipes`
+        # returns the file ids of the recipes; it is called under the lock so
+        # no upload can add a recipe between the listing and the deletions.
+        async with self._lock:
+            referenced: Set[str] = set()
+            for file_id in await list_recipes():
+                recipe = json.loads(await self._client.download_bytes(file_id))
+                referenced.update(digest for digest, _ in recipe["chunks"])
+            await self._async_refresh()
+            orphans = {digest: file_id for digest, file_id in self._chunks.items() if digest not in referenced}
+            if not orphans:
+                return
+            failed = set(await self._client.delete_files(list(orphans.values())))
+            for digest, file_id in orphans.items():
+                if file_id not in failed:
+                    self._chunks.pop(digest, None)
+            await self._store.async_save(self._data())
+            _LOGGER.debug("Removed %d unreferenced chunks", len(orphans) - len(failed))
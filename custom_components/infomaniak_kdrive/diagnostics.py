@@ -0,0 +1,24 @@
+
+from __future__ import annotations
+from typing import Any
+
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from .const import DOMAIN, DATA_CLIENT, DATA_MIRROR, CONF_TOKEN, CONF_ENCRYPTION_KEY
+
+TO_REDACT = {CONF_TOKEN, CONF_ENCRYPTION_KEY, "token", "access_token", "refresh_token"}
+
+async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigEntry) -> dict[str, Any]:
+    data = hass.data.get(DOMAIN, {}).get(entry.entry_id, {})
+    client = data.get(DATA_CLIENT)
+    mirror = data.get(DATA_MIRROR)
+    return {
+        "entry": {
+            "data": async_redact_data(dict(entry.data), TO_REDACT),
+            "options": async_redact_data(dict(entry.options), TO_REDACT),
+        },
+        "stats": client.stats.as_dict() if client else None,
+        "mirror_stats": mirror.stats.as_dict() if mirror else None,
+    }
@@ -0,0 +1,86 @@
+
+from __future__ import annotations
+import asyncio
+import json
+import logging
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from homeassistant.components.backup import AgentBackup
+
+from .client import KDriveClient
+from .const import INDEX_FILENAME
+
+_LOGGER = logging.getLogger(__name__)
+
+class BackupIndex:
+    # Sidecar JSON file kept in the backup folder. It stores the full
+    # AgentBackup of every upload, keyed by backup_id, so listing does not
+    # depend on what the filename can carry, along with the SHA-256 and size
+    # of the stored file for later verification.
+
+    def __init__(self, client: KDriveClient) -> None:
+        self._client = client
+        self._lock = asyncio.Lock()
+        # Last parsed index, keyed by the file id, modification time and size
+        self._cache: Optional[Tuple[Tuple[Any, ...], Dict[str, Dict[str, Any]]]] = None
+
+    @staticmethod
+    def is_index_file(item: dict) -> bool:
+        return item.get("name") == INDEX_FILENAME
+
+    async def async_load(self, item: Optional[dict]) -> Dict[str, Dict[str, Any]]:
+        # `item` is the index file entry of a folder listing, if any. An
+        # unreadable index reads as empty: listing falls back to filenames.
+        try:
+            return await self._async_read(item)
+        except Exception as err:
+            _LOGGER.warning("Could not read the backup index, falling back to filenames: %r", err)
+            return {}
+
+    async def _async_read(self, item: Optional[dict]) -> Dict[str, Dict[str, Any]]:
+        # Raises when the index exists but cannot be read, so updates never
+        # rewrite it from an empty copy
+        if item is None:
+            return {}
+        key = (item["id"], item.get("last_modified_at"), item.get("size"))
+        if self._cache is not None and key[1] is not None and self._cache[0] == key:
+            return dict(self._cache[1])
+        raw = await self._client.download_bytes(item["id"])
+        data = json.loads(raw)
+        backups = data.get("backups") if isinstance(data, dict) else None
+        if not isinstance(backups, dict):
+            raise ValueError("Backup index has an unexpected format")
+        self._cache = (key, backups)
+        return dict(backups)
+
+    async def async_put(self, backup: AgentBackup, file_name: str, sha256: Optional[str] = None, size: Optional[int] = None) -> None:
+        async with self._lock:
+            backups = await self._async_fetch()
+            backups[backup.backup_id] = {
+                "file_name": file_name,
+                "backup": backup.as_dict(),
+                "sha256": sha256,
+                "size": size,
+            }
+            await self._async_store(backups)
+
+    async def async_remove(self, backup_ids: Iterable[str]) -> None:
+        async with self._lock:
+            backups = await self._async_fetch()
+            removed = [backup_id for backup_id in backup_ids if backups.pop(backup_id, None) is not None]
+            if removed:
+                await self._async_store(backups)
+
+    async def _async_fetch(self) -> Dict[str, Dict[str, Any]]:
+        item = None
+        async for it in self._client.iter_folder_files():
+            if self.is_index_file(it):
+                item = it
+                break
+        return await self._async_read(item)
+
+    async def _async_store(self, backups: Dict[str, Dict[str, Any]]) -> None:
+        # Replaced in a single upload, readers see the old or the new version
+        self._cache = None
+        data = json.dumps({"version": 1, "backups": backups}, separators=(",", ":")).encode()
+        await self._client.upload_bytes(INDEX_FILENAME, data, conflict="version")
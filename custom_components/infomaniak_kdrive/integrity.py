@@ -0,0 +1,65 @@
+
+from __future__ import annotations
+import logging
+import time
+from typing import Any, Dict, List
+
+from .client import KDriveClient
+from .index import BackupIndex
+
+_LOGGER = logging.getLogger(__name__)
+
+async def async_verify_backups(client: KDriveClient, index: BackupIndex) -> Dict[str, Any]:
+    # Checks every stored backup against the SHA-256 and size recorded in the
+    # index at upload time, from a folder listing only (nothing is
+    # downloaded). The hash is compared when the API reports one, the size
+    # always.
+    items = await client.list_folder_files()
+    indexed = await index.async_load(next((it for it in items if BackupIndex.is_index_file(it)), None))
+    by_name = {it.get("name"): it for it in items}
+    verified = size_only = unrecorded = 0
+    missing: List[str] = []
+    mismatched: List[str] = []
+    for record in indexed.values():
+        name = record.get("file_name")
+        if not record.get("sha256"):
+            unrecorded += 1  # uploaded before hashes were recorded
+            continue
+        item = by_name.get(name)
+        if item is None:
+            missing.append(name)
+            continue
+        remote_hash = KDriveClient.remote_sha256(item)
+        size = item.get("size")
+        if (size is not None and int(size) != record.get("size")) or (remote_hash is not None and remote_hash != record["sha256"]):
+            mismatched.append(name)
+        elif remote_hash is not None:
+            verified += 1
+        else:
+            size_only += 1
+    return {
+        "checked_at": time.time(),
+        "verified": verified,
+        "size_only": size_only,
+        "unrecorded": unrecorded,
+        "missing": missing,
+        "mismatched": mismatched,
+    }
+
+
+async def async_run_verification(client: KDriveClient, index: BackupIndex) -> None:
+    try:
+        result = await async_verify_backups(client, index)
+    except Exception as err:
+        _LOGGER.warning("Backup verification failed: %r", err)
+        return
+    client.stats.record_verification(result)
+    if result["missing"] or result["mismatched"]:
+        _LOGGER.warning(
+            "Backup verification: %d missing, %d not matching their upload: %s",
+            len(result["missing"]),
+            len(result["mismatched"]),
+            result["missing"] + result["mismatched"],
+        )
+    else:
+        _LOGGER.debug("Backup verification: %s", result)
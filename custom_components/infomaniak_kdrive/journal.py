@@ -0,0 +1,79 @@
+
+from __future__ import annotations
+import time
+from typing import Any, Dict, List, Optional
+
+from homeassistant.core import HomeAssistant
+from homeassistant.helpers.storage import Store
+
+from .const import UPLOAD_JOURNAL_VERSION, UPLOAD_JOURNAL_SAVE_DELAY, UPLOAD_SESSION_MAX_AGE
+
+class UploadJournal:
+    # Persists the open kDrive upload sessions (one per target filename) and the
+    # chunks already acknowledged, so a retried upload can resume.
+
+    def __init__(self, hass: HomeAssistant, key: str) -> None:
+        self._store: Store = Store(hass, UPLOAD_JOURNAL_VERSION, key)
+        self._sessions: Optional[Dict[str, Dict[str, Any]]] = None
+
+    async def _async_load(self) -> Dict[str, Dict[str, Any]]:
+        if self._sessions is None:
+            data = await self._store.async_load() or {}
+            self._sessions = data.get("sessions", {})
+        return self._sessions
+
+    def _data(self) -> dict:
+        return {"sessions": self._sessions or {}}
+
+    async def async_get(self, filename: str) -> Optional[Dict[str, Any]]:
+        sessions = await self._async_load()
+        return sessions.get(filename)
+
+    @staticmethod
+    def is_expired(entry: Dict[str, Any]) -> bool:
+        return time.time() - entry.get("started_at", 0) >= UPLOAD_SESSION_MAX_AGE
+
+    @classmethod
+    def is_resumable(cls, entry: Dict[str, Any], total_size: int) -> bool:
+        return entry.get("total_size") == total_size and not cls.is_expired(entry)
+
+    async def async_prune(self) -> List[Dict[str, Any]]:
+        # Drops the sessions too old to resume (uploads that were never
+        # retried) and returns them so the caller can cancel them server side
+        sessions = await self._async_load()
+        expired = [filename for filename, entry in sessions.items() if self.is_expired(entry)]
+        if not expired:
+            return []
+        pruned = [sessions.pop(filename) for filename in expired]
+        await self._store.async_save(self._data())
+        return pruned
+
+    async def async_start(self, filename: str, *, token: str, upload_url: str, chunk_size: int, total_size: int) -> Dict[str, Any]:
+        sessions = await self._async_load()
+        entry = {
+            "token": token,
+            "upload_url": upload_url,
+            "chunk_size": chunk_size,
+            "total_size": total_size,
+            "started_at": time.time(),
+            "acked": [],
+        }
+        sessions[filename] = entry
+        await self._store.async_save(self._data())
+        return entry
+
+    def mark_acked(self, filename: str, chunk_number: int) -> None:
+        entry = (self._sessions or {}).get(filename)
+        if entry is None:
+            return
+        entry["acked"].append(chunk_number)
+        self._store.async_delay_save(self._data, UPLOAD_JOURNAL_SAVE_DELAY)
+
+    async def async_remove(self, filename: str) -> None:
+        sessions = await self._async_load()
+        if sessions.pop(filename, None) is not None:
+            await self._store.async_save(self._data())
+
+    async def async_flush(self) -> None:
+        if self._sessions is not None:
+            await self._store.async_save(self._data())
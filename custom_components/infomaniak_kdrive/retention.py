@@ -0,0 +1,84 @@
+
+from __future__ import annotations
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Hashable, List, Optional, Set
+
+from homeassistant.util import dt as dt_util
+
+@dataclass
+class RetentionPolicy:
+    keep_last: Optional[int] = None
+    keep_within_days: Optional[int] = None
+    keep_daily: int = 0
+    keep_weekly: int = 0
+    keep_monthly: int = 0
+    max_total_size: Optional[int] = None  # bytes
+
+    @property
+    def enabled(self) -> bool:
+        return bool(
+            self.keep_last
+            or self.keep_within_days
+            or self.keep_daily
+            or self.keep_weekly
+            or self.keep_monthly
+            or self.max_total_size
+        )
+
+
+@dataclass
+class RetentionItem:
+    key: Any
+    date: datetime
+    size: int
+
+
+def select_deletions(items: List[RetentionItem], policy: RetentionPolicy, now: datetime) -> List[RetentionItem]:
+    # Returns the items to delete, oldest first. An item is kept if any rule
+    # keeps it (keep-last, keep-within, one per day/week/month), then kept
+    # items are counted newest first against max_total_size and the ones that
+    # do not fit are dropped. The newest backup is always kept.
+    if not policy.enabled or not items:
+        return []
+    newest_first = sorted(items, key=lambda it: it.date, reverse=True)
+    keep: Set[int] = set()
+
+    count_rules = policy.keep_last or policy.keep_within_days or policy.keep_daily or policy.keep_weekly or policy.keep_monthly
+    if not count_rules:
+        keep.update(range(len(newest_first)))
+    if policy.keep_last:
+        keep.update(range(min(policy.keep_last, len(newest_first))))
+    if policy.keep_within_days:
+        limit = now - timedelta(days=policy.keep_within_days)
+        keep.update(i for i, it in enumerate(newest_first) if it.date >= limit)
+
+    def keep_one_per(period: Callable[[datetime], Hashable], count: int) -> None:
+        # Days, weeks and months are the local ones: the dates come with
+        # different offsets (filename, index, kDrive timestamps)
+        seen: Set[Hashable] = set()
+        for i, it in enumerate(newest_first):
+            if len(seen) >= count:
+                break
+            bucket = period(dt_util.as_local(it.date))
+            if bucket not in seen:
+                seen.add(bucket)
+                keep.add(i)
+
+    if policy.keep_daily:
+        keep_one_per(lambda d: d.date(), policy.keep_daily)
+    if policy.keep_weekly:
+        keep_one_per(lambda d: d.isocalendar()[:2], policy.keep_weekly)
+    if policy.keep_monthly:
+        keep_one_per(lambda d: (d.year, d.month), policy.keep_monthly)
+
+    keep.add(0)
+    if policy.max_total_size:
+        total = 0
+        for i in sorted(keep):
+            total += newest_first[i].size
+            if i and total > policy.max_total_size:
+                keep.discard(i)
+                total -= newest_first[i].size
+
+    return [it for i, it in reversed(list(enumerate(newest_first))) if i not in keep]
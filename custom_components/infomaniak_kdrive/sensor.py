@@ -0,0 +1,119 @@
+
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Optional
+
+from homeassistant.components.sensor import (
+    SensorDeviceClass,
+    SensorEntity,
+    SensorEntityDescription,
+    SensorStateClass,
+)
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.const import EntityCategory, UnitOfDataRate, UnitOfTime
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.helpers.device_registry import DeviceEntryType, DeviceInfo
+from homeassistant.helpers.entity_platform import AddEntitiesCallback
+
+from .const import DOMAIN, DATA_CLIENT, AGENT_NAME
+from .stats import TransferStats
+
+@dataclass(frozen=True, kw_only=True)
+class KDriveSensorEntityDescription(SensorEntityDescription):
+    value_fn: Callable[[TransferStats], Any]
+    attrs_fn: Optional[Callable[[TransferStats], Optional[Dict[str, Any]]]] = None
+
+
+SENSORS: tuple[KDriveSensorEntityDescription, ...] = (
+    KDriveSensorEntityDescription(
+        key="upload_throughput",
+        name="Last upload throughput",
+        device_class=SensorDeviceClass.DATA_RATE,
+        state_class=SensorStateClass.MEASUREMENT,
+        native_unit_of_measurement=UnitOfDataRate.BYTES_PER_SECOND,
+        suggested_unit_of_measurement=UnitOfDataRate.MEGABYTES_PER_SECOND,
+        value_fn=lambda stats: stats.last_upload.throughput if stats.last_upload else None,
+        attrs_fn=lambda stats: stats.last_upload.as_dict() if stats.last_upload else None,
+    ),
+    KDriveSensorEntityDescription(
+        key="upload_duration",
+        name="Last upload duration",
+        device_class=SensorDeviceClass.DURATION,
+        state_class=SensorStateClass.MEASUREMENT,
+        native_unit_of_measurement=UnitOfTime.SECONDS,
+        value_fn=lambda stats: stats.last_upload.duration if stats.last_upload else None,
+    ),
+    KDriveSensorEntityDescription(
+        key="download_throughput",
+        name="Last download throughput",
+        device_class=SensorDeviceClass.DATA_RATE,
+        state_class=SensorStateClass.MEASUREMENT,
+        native_unit_of_measurement=UnitOfDataRate.BYTES_PER_SECOND,
+        suggested_unit_of_measurement=UnitOfDataRate.MEGABYTES_PER_SECOND,
+        value_fn=lambda stats: stats.last_download.throughput if stats.last_download else None,
+        attrs_fn=lambda stats: stats.last_download.as_dict() if stats.last_download else None,
+    ),
+    KDriveSensorEntityDescription(
+        key="list_latency",
+        name="Folder listing latency",
+        device_class=SensorDeviceClass.DURATION,
+        state_class=SensorStateClass.MEASUREMENT,
+        native_unit_of_measurement=UnitOfTime.SECONDS,
+        value_fn=lambda stats: stats.list_latency,
+    ),
+    KDriveSensorEntityDescription(
+        key="retries",
+        name="Transfer retries",
+        state_class=SensorStateClass.TOTAL_INCREASING,
+        entity_category=EntityCategory.DIAGNOSTIC,
+        value_fn=lambda stats: stats.retries,
+    ),
+    KDriveSensorEntityDescription(
+        key="integrity_problems",
+        name="Backups failing verification",
+        entity_category=EntityCategory.DIAGNOSTIC,
+        value_fn=lambda stats: (
+            len(stats.last_verification["missing"]) + len(stats.last_verification["mismatched"])
+            if stats.last_verification else None
+        ),
+        attrs_fn=lambda stats: stats.last_verification,
+    ),
+)
+
+async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback) -> None:
+    stats: TransferStats = hass.data[DOMAIN][entry.entry_id][DATA_CLIENT].stats
+    async_add_entities(KDriveStatsSensor(entry, stats, description) for description in SENSORS)
+
+class KDriveStatsSensor(SensorEntity):
+    _attr_has_entity_name = True
+    _attr_should_poll = False
+    entity_description: KDriveSensorEntityDescription
+
+    def __init__(self, entry: ConfigEntry, stats: TransferStats, description: KDriveSensorEntityDescription) -> None:
+        self.entity_description = description
+        self._stats = stats
+        self._attr_unique_id = f"{entry.entry_id}_{description.key}"
+        self._attr_device_info = DeviceInfo(
+            identifiers={(DOMAIN, entry.entry_id)},
+            name=entry.title,
+            manufacturer="Infomaniak",
+            model=AGENT_NAME,
+            entry_type=DeviceEntryType.SERVICE,
+        )
+
+    async def async_added_to_hass(self) -> None:
+        self.async_on_remove(self._stats.async_add_listener(self._handle_update))
+
+    @callback
+    def _handle_update(self) -> None:
+        self.async_write_ha_state()
+
+    @property
+    def native_value(self) -> Any:
+        return self.entity_description.value_fn(self._stats)
+
+    @property
+    def extra_state_attributes(self) -> Optional[Dict[str, Any]]:
+        if self.entity_description.attrs_fn is None:
+            return None
+        return self.entity_description.attrs_fn(self._stats)
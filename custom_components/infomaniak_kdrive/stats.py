@@ -0,0 +1,127 @@
+
+from __future__ import annotations
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from homeassistant.core import callback
+
+SPEED_SMOOTHING = 0.3  # weight of the newest sample
+
+class TransferTimer:
+    # Timing of a single upload or download, split by phase.
+
+    def __init__(self, kind: str, name: str) -> None:
+        self.kind = kind
+        self.name = name
+        self.started_at = time.time()
+        self._start = time.monotonic()
+        self.duration: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.chunk_durations: List[float] = []
+        self.bytes = 0
+        self.retries = 0
+        self.success: Optional[bool] = None
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.monotonic() - start
+
+    def stop(self, success: bool) -> None:
+        self.duration = time.monotonic() - self._start
+        self.success = success
+
+    @property
+    def throughput(self) -> Optional[float]:
+        if not self.duration:
+            return None
+        return self.bytes / self.duration
+
+    def as_dict(self) -> Dict[str, Any]:
+        chunks = self.chunk_durations
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "success": self.success,
+            "bytes": self.bytes,
+            "duration": self.duration,
+            "throughput": self.throughput,
+            "phases": {k: round(v, 3) for k, v in self.phases.items()},
+            "chunks": len(chunks),
+            "chunk_avg": sum(chunks) / len(chunks) if chunks else None,
+            "chunk_max": max(chunks) if chunks else None,
+            "retries": self.retries,
+        }
+
+
+class TransferStats:
+    # Last transfers and counters of a KDriveClient, read by the sensors and
+    # the diagnostics.
+
+    def __init__(self) -> None:
+        self.last_upload: Optional[TransferTimer] = None
+        self.last_download: Optional[TransferTimer] = None
+        self.list_latency: Optional[float] = None
+        self.upload_speed: Optional[float] = None  # bytes/s of one request, smoothed
+        self.last_verification: Optional[Dict[str, Any]] = None
+        self.retries = 0
+        self._listeners: List[Callable[[], None]] = []
+
+    @callback
+    def async_add_listener(self, listener: Callable[[], None]) -> Callable[[], None]:
+        self._listeners.append(listener)
+
+        @callback
+        def remove_listener() -> None:
+            self._listeners.remove(listener)
+
+        return remove_listener
+
+    def _notify(self) -> None:
+        for listener in list(self._listeners):
+            listener()
+
+    def record_transfer(self, timer: TransferTimer, success: bool) -> None:
+        timer.stop(success)
+        if timer.kind == "upload":
+            self.last_upload = timer
+        else:
+            self.last_download = timer
+        self._notify()
+
+    def record_retry(self, timer: Optional[TransferTimer] = None) -> None:
+        self.retries += 1
+        if timer is not None:
+            timer.retries += 1
+        self._notify()
+
+    def record_upload_speed(self, size: int, duration: float) -> None:
+        if duration <= 0:
+            return
+        speed = size / duration
+        if self.upload_speed is None:
+            self.upload_speed = speed
+        else:
+            self.upload_speed += SPEED_SMOOTHING * (speed - self.upload_speed)
+
+    def record_verification(self, result: Dict[str, Any]) -> None:
+        self.last_verification = result
+        self._notify()
+
+    def record_list(self, latency: float) -> None:
+        self.list_latency = latency
+        self._notify()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "last_upload": self.last_upload.as_dict() if self.last_upload else None,
+            "last_download": self.last_download.as_dict() if self.last_download else None,
+            "list_latency": self.list_latency,
+            "upload_speed": self.upload_speed,
+            "last_verification": self.last_verification,
+            "retries": self.retries,
+        }
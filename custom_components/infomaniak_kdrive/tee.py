@@ -0,0 +1,75 @@
+
+from __future__ import annotations
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Set
+
+from .const import TEE_QUEUE_SIZE
+
+OpenStream = Callable[[], Awaitable[AsyncIterator[bytes]]]
+
+_END = object()
+
+class StreamTee:
+    # Feeds a single read of a backup to several uploads. Each consumer has
+    # its own bounded queue, so the fastest one runs at most TEE_QUEUE_SIZE
+    # parts ahead of the slowest. A consumer that stops (or never starts) is
+    # detached and no longer holds the others back.
+
+    def __init__(self, open_stream: OpenStream, count: int) -> None:
+        self._open_stream = open_stream
+        self._queues: List[asyncio.Queue] = [asyncio.Queue(TEE_QUEUE_SIZE) for _ in range(count)]
+        self._active: Set[int] = set(range(count))
+        self._opened: Set[int] = set()
+        self._pump: Optional[asyncio.Task] = None
+
+    def opener(self, index: int) -> OpenStream:
+        async def open_stream() -> AsyncIterator[bytes]:
+            if index in self._opened or index not in self._active:
+                # A second read cannot share the first one
+                return await self._open_stream()
+            self._opened.add(index)
+            if self._pump is None:
+                self._pump = asyncio.create_task(self._run())
+            return self._consume(index)
+        return open_stream
+
+    def detach(self, index: int) -> None:
+        self._active.discard(index)
+        queue = self._queues[index]
+        # Unblock the pump if it waits on this queue
+        while not queue.empty():
+            queue.get_nowait()
+
+    async def aclose(self) -> None:
+        for index in range(len(self._queues)):
+            self.detach(index)
+        if self._pump is not None:
+            self._pump.cancel()
+            await asyncio.gather(self._pump, return_exceptions=True)
+
+    async def _run(self) -> None:
+        end: object = _END
+        try:
+            stream = await self._open_stream()
+            async for part in stream:
+                if not self._active:
+                    break
+                for index in list(self._active):
+                    await self._queues[index].put(part)
+        except Exception as err:
+            end = err
+        for index in list(self._active):
+            await self._queues[index].put(end)
+
+    async def _consume(self, index: int) -> AsyncIterator[bytes]:
+        queue = self._queues[index]
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.detach(index)
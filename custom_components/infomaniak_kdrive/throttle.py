@@ -0,0 +1,97 @@
+
+from __future__ import annotations
+import asyncio
+import re
+import time
+from datetime import time as dt_time
+from typing import AsyncIterator, List, Optional, Tuple
+
+from homeassistant.util import dt as dt_util
+
+from .const import THROTTLE_SLICE_SIZE
+
+_PROFILE_RE = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\d+)\s*$")
+
+Profile = Tuple[dt_time, dt_time, int]  # start, end, KiB/s (0 = unlimited)
+
+def parse_schedule(value: str) -> List[Profile]:
+    # "08:00-23:00=512, 23:00-08:00=0": KiB/s per time-of-day window. A
+    # window may wrap around midnight. Raises ValueError on bad input.
+    profiles: List[Profile] = []
+    for part in filter(None, (p.strip() for p in (value or "").split(","))):
+        m = _PROFILE_RE.match(part)
+        if not m:
+            raise ValueError(f"Invalid bandwidth profile: {part}")
+        h1, m1, h2, m2, rate = (int(g) for g in m.groups())
+        profiles.append((dt_time(h1, m1), dt_time(h2, m2), rate))
+    return profiles
+
+
+class BandwidthLimiter:
+    # Token bucket shared by every upload of a client. The rate is looked up
+    # on each refill, so option changes and schedule windows apply mid-upload.
+
+    def __init__(self, limit: int = 0, schedule: Optional[List[Profile]] = None) -> None:
+        self._limit = limit  # KiB/s outside the schedule, 0 = unlimited
+        self._schedule = schedule or []
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def configure(self, limit: int, schedule: Optional[List[Profile]] = None) -> None:
+        self._limit = limit
+        self._schedule = schedule or []
+
+    @property
+    def rate(self) -> Optional[float]:
+        # Current rate in bytes/s, None when unlimited
+        kib = self._limit
+        now = dt_util.now().time()
+        for start, end, profile_kib in self._schedule:
+            inside = start <= now < end if start <= end else (now >= start or now < end)
+            if inside:
+                kib = profile_kib
+                break
+        return kib * 1024 if kib else None
+
+    @property
+    def enabled(self) -> bool:
+        return self._limit > 0 or bool(self._schedule)
+
+    def _refill(self, rate: float) -> None:
+        now = time.monotonic()
+        # Allow at most one second of burst
+        self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+        self._last = now
+
+    async def consume(self, size: int) -> None:
+        rate = self.rate
+        if rate is None:
+            self._tokens = 0.0
+            self._last = time.monotonic()
+            return
+        async with self._lock:
+            self._refill(rate)
+            self._tokens -= size
+            # Sleep in short steps so a rate change is picked up quickly
+            while self._tokens < 0:
+                rate = self.rate
+                if rate is None:
+                    self._tokens = 0.0
+                    break
+                await asyncio.sleep(min(1.0, -self._tokens / rate))
+                self._refill(rate)
+
+    async def pace(self, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for part in stream:
+            for i in range(0, len(part), THROTTLE_SLICE_SIZE):
+                piece = part[i:i + THROTTLE_SLICE_SIZE]
+                await self.consume(len(piece))
+                yield piece
+
+    async def pace_bytes(self, data: bytes) -> AsyncIterator[bytes]:
+        view = memoryview(data)
+        for i in range(0, len(data), THROTTLE_SLICE_SIZE):
+            piece = view[i:i + THROTTLE_SLICE_SIZE]
+            await self.consume(len(piece))
+            yield bytes(piece)
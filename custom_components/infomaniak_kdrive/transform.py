@@ -0,0 +1,154 @@
+
+from __future__ import annotations
+import hashlib
+import os
+import struct
+from typing import AsyncIterator, Optional, Sequence
+
+import zstandard
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from homeassistant.core import HomeAssistant
+
+from .const import (
+    TRANSFORM_BLOCK_SIZE,
+    TRANSFORM_ZSTD_LEVEL,
+    XF_AESGCM,
+    XF_ZSTD,
+)
+
+# Encrypted stream layout: MAGIC | salt (16) | nonce prefix (4), then frames of
+# flag (1) | length (4) | AES-GCM ciphertext+tag. The flag (1 on the last
+# frame) is authenticated, so a truncated stream is detected.
+MAGIC = b"KDX1"
+_HEADER = struct.Struct(">4s16s4s")
+_FRAME = struct.Struct(">BI")
+
+class TransformError(Exception):
+    pass
+
+
+async def _blocks(stream: AsyncIterator[bytes], size: int) -> AsyncIterator[bytes]:
+    buf = bytearray()
+    async for part in stream:
+        buf += part
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def _derive_key(passphrase: str, salt: bytes) -> bytes:
+    return hashlib.scrypt(passphrase.encode(), salt=salt, n=2 ** 14, r=8, p=1, dklen=32)
+
+
+def _nonce(prefix: bytes, counter: int) -> bytes:
+    return prefix + counter.to_bytes(8, "big")
+
+
+async def compress_stream(hass: HomeAssistant, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    cobj = zstandard.ZstdCompressor(level=TRANSFORM_ZSTD_LEVEL).compressobj()
+    async for block in _blocks(stream, TRANSFORM_BLOCK_SIZE):
+        out = await hass.async_add_executor_job(cobj.compress, block)
+        if out:
+            yield out
+    yield cobj.flush()
+
+
+async def decompress_stream(hass: HomeAssistant, stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    # Small input blocks keep each decompressed piece bounded
+    dobj = zstandard.ZstdDecompressor().decompressobj()
+    async for block in _blocks(stream, 64 * 1024):
+        if dobj.eof:
+            raise TransformError("Data after the end of the compressed backup")
+        out = await hass.async_add_executor_job(dobj.decompress, block)
+        if out:
+            yield out
+    if not dobj.eof:
+        raise TransformError("Compressed backup is truncated")
+    if dobj.unused_data:
+        raise TransformError("Data after the end of the compressed backup")
+
+
+async def encrypt_stream(hass: HomeAssistant, stream: AsyncIterator[bytes], passphrase: str) -> AsyncIterator[bytes]:
+    salt, prefix = os.urandom(16), os.urandom(4)
+    aes = AESGCM(await hass.async_add_executor_job(_derive_key, passphrase, salt))
+    yield _HEADER.pack(MAGIC, salt, prefix)
+    counter = 0
+    pending: Optional[bytes] = None
+    # Hold one block back so the last frame can be flagged
+    async for block in _blocks(stream, TRANSFORM_BLOCK_SIZE):
+        if pending is not None:
+            yield await _seal(hass, aes, prefix, counter, pending, final=False)
+            counter += 1
+        pending = block
+    yield await _seal(hass, aes, prefix, counter, pending or b"", final=True)
+
+
+async def _seal(hass: HomeAssistant, aes: AESGCM, prefix: bytes, counter: int, block: bytes, final: bool) -> bytes:
+    flag = 1 if final else 0
+    ct = await hass.async_add_executor_job(aes.encrypt, _nonce(prefix, counter), block, bytes([flag]))
+    return _FRAME.pack(flag, len(ct)) + ct
+
+
+async def decrypt_stream(hass: HomeAssistant, stream: AsyncIterator[bytes], passphrase: str) -> AsyncIterator[bytes]:
+    buf = bytearray()
+    aes: Optional[AESGCM] = None
+    prefix = b""
+    counter = 0
+    final = False
+    async for part in stream:
+        buf += part
+        if aes is None:
+            if len(buf) < _HEADER.size:
+                continue
+            magic, salt, prefix = _HEADER.unpack_from(buf)
+            if magic != MAGIC:
+                raise TransformError("Not an encrypted kDrive backup")
+            del buf[:_HEADER.size]
+            aes = AESGCM(await hass.async_add_executor_job(_derive_key, passphrase, salt))
+        while len(buf) >= _FRAME.size:
+            flag, length = _FRAME.unpack_from(buf)
+            if len(buf) < _FRAME.size + length:
+                break
+            if final:
+                raise TransformError("Data after the last encrypted frame")
+            ct = bytes(buf[_FRAME.size:_FRAME.size + length])
+            del buf[:_FRAME.size + length]
+            try:
+                block = await hass.async_add_executor_job(aes.decrypt, _nonce(prefix, counter), ct, bytes([flag]))
+            except Exception as err:
+                raise TransformError("Backup decryption failed (wrong key or corrupted data)") from err
+            counter += 1
+            final = flag == 1
+            if block:
+                yield block
+    if not final or buf:
+        raise TransformError("Encrypted backup is truncated")
+
+
+def apply_transforms(hass: HomeAssistant, stream: AsyncIterator[bytes], transforms: Sequence[str], passphrase: Optional[str]) -> AsyncIterator[bytes]:
+    for name in transforms:
+        if name == XF_ZSTD:
+            stream = compress_stream(hass, stream)
+        elif name == XF_AESGCM:
+            if not passphrase:
+                raise TransformError("No encryption key configured")
+            stream = encrypt_stream(hass, stream, passphrase)
+        else:
+            raise TransformError(f"Unknown transform: {name}")
+    return stream
+
+
+def revert_transforms(hass: HomeAssistant, stream: AsyncIterator[bytes], transforms: Sequence[str], passphrase: Optional[str]) -> AsyncIterator[bytes]:
+    for name in reversed(transforms):
+        if name == XF_ZSTD:
+            stream = decompress_stream(hass, stream)
+        elif name == XF_AESGCM:
+            if not passphrase:
+                raise TransformError("No encryption key configured")
+            stream = decrypt_stream(hass, stream, passphrase)
+        else:
+            raise TransformError(f"Unknown transform: {name}")
+    return stream
@@ -0,0 +1 @@
+"""Tests for the Infomaniak kDrive backup agent."""
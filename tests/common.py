@@ -0,0 +1,74 @@
+"""Helpers shared by the tests."""
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import resource
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, List
+
+TICK = 0.01  # seconds between two probe samples
+
+
+def random_bytes(size: int, seed: int = 0) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+async def iter_bytes(data: bytes, part: int = 64 * 1024) -> AsyncIterator[bytes]:
+    for i in range(0, len(data), part):
+        yield data[i:i + part]
+
+
+def opener(data: bytes, part: int = 64 * 1024) -> Callable[[], Awaitable[AsyncIterator[bytes]]]:
+    # open_stream callable, as handed to backup agents by HA
+    async def open_stream() -> AsyncIterator[bytes]:
+        return iter_bytes(data, part)
+    return open_stream
+
+
+async def collect(stream: AsyncIterator[bytes]) -> bytes:
+    return b"".join([part async for part in stream])
+
+
+def rss() -> int:
+    # Current resident set size in bytes
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Probe:
+    # Samples RSS and the event-loop lag every TICK seconds
+    def __init__(self) -> None:
+        self.peak_rss = 0
+        self.lags: List[float] = []
+
+    async def run(self) -> None:
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(TICK)
+            self.lags.append(time.monotonic() - start - TICK)
+            self.peak_rss = max(self.peak_rss, rss())
+
+    def report(self) -> Dict[str, float]:
+        lags = sorted(self.lags) or [0.0]
+        return {
+            "peak_rss_mb": self.peak_rss / 1024 ** 2,
+            "lag_max_ms": lags[-1] * 1000,
+            "lag_p99_ms": lags[int(len(lags) * 0.99)] * 1000,
+        }
+
+
+@asynccontextmanager
+async def probe() -> AsyncIterator[Probe]:
+    result = Probe()
+    task = asyncio.create_task(result.run())
+    try:
+        yield result
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
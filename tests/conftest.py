@@ -0,0 +1,42 @@
+"""Shared fixtures: a fake kDrive server and clients pointed at it."""
+from __future__ import annotations
+
+from typing import Any, Callable, List
+
+import pytest
+
+from custom_components.infomaniak_kdrive.client import KDriveClient
+
+from .fake_kdrive import DRIVE_ID, FOLDER_ID, TOKEN, FakeKDrive
+
+
+@pytest.fixture(autouse=True)
+def auto_enable_custom_integrations(enable_custom_integrations):
+    yield
+
+
+@pytest.fixture
+async def kdrive(socket_enabled):
+    server = FakeKDrive()
+    await server.start()
+    yield server
+    await server.close()
+
+
+@pytest.fixture
+async def make_client(hass, kdrive) -> Callable[..., KDriveClient]:
+    clients: List[KDriveClient] = []
+
+    def make(**kwargs: Any) -> KDriveClient:
+        client = KDriveClient(hass, TOKEN, DRIVE_ID, FOLDER_ID, api_url=kdrive.url, **kwargs)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        await client.async_close()
+
+
+@pytest.fixture
+async def client(make_client) -> KDriveClient:
+    return make_client()
@@ -0,0 +1,355 @@
+"""Local stand-in for the kDrive v2/v3 endpoints the client uses."""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import itertools
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+DRIVE_ID = 123
+FOLDER_ID = 456
+TOKEN = "test-token"
+
+_PART = 64 * 1024
+_FILLER = bytes(range(256)) * (_PART // 256 + 1)  # served for content not kept
+
+
+@dataclass
+class FakeFile:
+    id: int
+    name: str
+    parent_id: int
+    type: str = "file"
+    data: Optional[bytes] = None  # None when the content is not kept
+    size: int = 0
+    sha256: Optional[str] = None
+    last_modified_at: int = field(default_factory=lambda: int(time.time()))
+    created_at: int = field(default_factory=lambda: int(time.time()))
+
+    def item(self, report_hash: bool) -> Dict[str, Any]:
+        item = {
+            "id": self.id,
+            "name": self.name,
+            "type": self.type,
+            "parent_id": self.parent_id,
+            "last_modified_at": self.last_modified_at,
+            "created_at": self.created_at,
+        }
+        if self.type == "file":
+            item["size"] = self.size
+            if report_hash and self.sha256:
+                item["hash"] = f"sha256:{self.sha256}"
+        return item
+
+
+@dataclass
+class Fault:
+    # Answer `count` requests matching `route` (and `method`, if set) with
+    # `status`, after letting `skip` of them through
+    route: str
+    status: int
+    count: int = 1
+    method: Optional[str] = None
+    retry_after: Optional[str] = "0"
+    skip: int = 0
+
+
+class FakeKDrive:
+    """In-memory kDrive with injectable latency, bandwidth cap and errors.
+
+    `latency` is added to every request (seconds), `bandwidth` caps request
+    and response bodies (bytes/s, per request), `error_rate` answers that
+    share of the requests with a 503. `fail()` queues deterministic errors
+    for one route. With `keep_data=False` uploads only keep their size, and
+    downloads serve filler bytes, so multi-GB runs fit in memory.
+    """
+
+    def __init__(
+        self,
+        *,
+        latency: float = 0.0,
+        bandwidth: Optional[float] = None,
+        error_rate: float = 0.0,
+        keep_data: bool = True,
+        report_hash: bool = True,
+        ranges: bool = True,
+        head: bool = True,
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.keep_data = keep_data
+        self.report_hash = report_hash
+        self.ranges = ranges
+        self.head = head
+        self.files: Dict[int, FakeFile] = {}
+        self.trash: Dict[int, FakeFile] = {}
+        self.sessions: Dict[str, Dict[str, Any]] = {}
+        self.requests: List[Tuple[str, str]] = []  # (method, route name)
+        self.in_flight: Dict[str, int] = {}
+        self.peak_in_flight: Dict[str, int] = {}  # per route name
+        self._faults: List[Fault] = []
+        self._ids = itertools.count(1000)
+        self._random = random.Random(seed)
+        self._server: Optional[TestServer] = None
+        self.add_folder(FOLDER_ID, "backups", parent_id=1)
+
+    # --- setup --------------------------------------------------------------
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None, "server not started"
+        return str(self._server.make_url("")).rstrip("/")
+
+    async def start(self) -> None:
+        self._server = TestServer(self._app(), host="127.0.0.1")
+        await self._server.start_server()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            await self._server.close()
+
+    def add_folder(self, folder_id: int, name: str, parent_id: int = FOLDER_ID) -> FakeFile:
+        folder = FakeFile(id=folder_id, name=name, parent_id=parent_id, type="dir")
+        self.files[folder_id] = folder
+        return folder
+
+    def add_file(self, name: str, data: bytes, parent_id: int = FOLDER_ID) -> FakeFile:
+        return self._store(name, parent_id, data, len(data), hashlib.sha256(data).hexdigest())
+
+    def fail(self, route: str, status: int = 503, count: int = 1, *, skip: int = 0, method: Optional[str] = None, retry_after: Optional[str] = "0") -> None:
+        self._faults.append(Fault(route, status, count, method, retry_after, skip))
+
+    def by_name(self, name: str, parent_id: int = FOLDER_ID) -> Optional[FakeFile]:
+        return next((f for f in self.files.values() if f.name == name and f.parent_id == parent_id), None)
+
+    def children(self, parent_id: int = FOLDER_ID) -> List[FakeFile]:
+        return [f for f in self.files.values() if f.parent_id == parent_id]
+
+    def count(self, route: str, method: Optional[str] = None) -> int:
+        return sum(1 for m, r in self.requests if r == route and (method is None or m == method))
+
+    # --- plumbing -----------------------------------------------------------
+
+    def _app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware], client_max_size=1024 ** 3)
+        v2 = f"/2/drive/{DRIVE_ID}"
+        v3 = f"/3/drive/{DRIVE_ID}"
+        app.router.add_route("GET", f"{v3}/files/{{file_id}}/files", self._list, name="list")
+        app.router.add_route("GET", f"{v3}/files/{{file_id}}/download", self._download, name="download")
+        app.router.add_route("HEAD", f"{v3}/files/{{file_id}}/download", self._head, name="head")
+        app.router.add_route("POST", f"{v3}/files/{{file_id}}/directory", self._directory, name="directory")
+        app.router.add_route("POST", f"{v3}/upload", self._upload, name="upload")
+        app.router.add_route("POST", f"{v3}/upload/session/start", self._session_start, name="session_start")
+        app.router.add_route("POST", f"{v3}/upload/session/{{token}}/chunk", self._session_chunk, name="chunk")
+        app.router.add_route("POST", f"{v3}/upload/session/{{token}}/finish", self._session_finish, name="finish")
+        app.router.add_route("DELETE", f"{v2}/upload/session/{{token}}", self._session_cancel, name="cancel")
+        app.router.add_route("DELETE", f"{v2}/files/{{file_id}}", self._delete, name="delete")
+        app.router.add_route("DELETE", f"{v2}/trash/{{file_id}}", self._purge, name="purge")
+        return app
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        route = request.match_info.route.name or "unknown"
+        self.requests.append((request.method, route))
+        self.in_flight[route] = self.in_flight.get(route, 0) + 1
+        self.peak_in_flight[route] = max(self.peak_in_flight.get(route, 0), self.in_flight[route])
+        try:
+            return await self._handle(request, handler, route)
+        finally:
+            self.in_flight[route] -= 1
+
+    async def _handle(self, request: web.Request, handler, route: str) -> web.StreamResponse:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.headers.get("Authorization") != f"Bearer {TOKEN}":
+            return _error(401, "not_authorized")
+        fault = next(
+            (f for f in self._faults if f.route == route and f.count > 0 and f.method in (None, request.method)),
+            None,
+        )
+        if fault is not None and fault.skip:
+            fault.skip -= 1
+        elif fault is not None:
+            fault.count -= 1
+            await request.read()  # let the client finish sending
+            return _error(fault.status, "injected", fault.retry_after)
+        if self.error_rate and self._random.random() < self.error_rate:
+            await request.read()
+            return _error(503, "injected", "0")
+        return await handler(request)
+
+    async def _pace(self, size: int) -> None:
+        if self.bandwidth:
+            await asyncio.sleep(size / self.bandwidth)
+
+    async def _body(self, request: web.Request) -> AsyncIterator[bytes]:
+        async for part in request.content.iter_chunked(_PART):
+            await self._pace(len(part))
+            yield part
+
+    async def _read_body(self, request: web.Request) -> Tuple[Optional[bytes], int, str]:
+        # Returns the body (None unless kept), its size and SHA-256
+        digest = hashlib.sha256()
+        buf = bytearray() if self.keep_data else None
+        size = 0
+        async for part in self._body(request):
+            digest.update(part)
+            size += len(part)
+            if buf is not None:
+                buf += part
+        return (bytes(buf) if buf is not None else None), size, digest.hexdigest()
+
+    def _store(self, name: str, parent_id: int, data: Optional[bytes], size: int, sha256: str, conflict: str = "version") -> FakeFile:
+        existing = self.by_name(name, parent_id)
+        if existing is not None:
+            if conflict == "error":
+                raise web.HTTPConflict(text='{"result":"error","error":{"code":"conflict_error"}}', content_type="application/json")
+            existing.data, existing.size, existing.sha256 = data, size, sha256
+            existing.last_modified_at += 1
+            return existing
+        file = FakeFile(id=next(self._ids), name=name, parent_id=parent_id, data=data, size=size, sha256=sha256)
+        self.files[file.id] = file
+        return file
+
+    def _file(self, request: web.Request, type: str = "file") -> FakeFile:
+        file = self.files.get(int(request.match_info["file_id"]))
+        if file is None or file.type != type:
+            raise web.HTTPNotFound()
+        return file
+
+    def _content(self, file: FakeFile, start: int, end: int) -> bytes:
+        if file.data is not None:
+            return file.data[start:end + 1]
+        offset = start % 256
+        return _FILLER[offset:offset + end - start + 1]
+
+    # --- handlers -----------------------------------------------------------
+
+    async def _list(self, request: web.Request) -> web.Response:
+        folder = self._file(request, "dir")
+        limit = int(request.query.get("limit", 1000))
+        offset = int(request.query.get("cursor", 0))
+        items = sorted(self.children(folder.id), key=lambda f: f.id)
+        page = items[offset:offset + limit]
+        has_more = offset + limit < len(items)
+        return web.json_response({
+            "result": "success",
+            "data": [f.item(self.report_hash) for f in page],
+            "has_more": has_more,
+            "cursor": str(offset + limit) if has_more else None,
+        })
+
+    async def _head(self, request: web.Request) -> web.Response:
+        if not self.head:
+            raise web.HTTPMethodNotAllowed("HEAD", ["GET"])
+        file = self._file(request)
+        return web.Response(headers={"Content-Length": str(file.size), "Accept-Ranges": "bytes"})
+
+    async def _download(self, request: web.Request) -> web.StreamResponse:
+        file = self._file(request)
+        start, end, status = 0, file.size - 1, 200
+        spec = request.headers.get("Range")
+        if spec and self.ranges:
+            first, _, last = spec.removeprefix("bytes=").partition("-")
+            start = int(first)
+            end = min(int(last), file.size - 1) if last else file.size - 1
+            if start >= file.size:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{file.size}"})
+            status = 206
+        resp = web.StreamResponse(status=status)
+        resp.content_length = end - start + 1
+        if status == 206:
+            resp.headers["Content-Range"] = f"bytes {start}-{end}/{file.size}"
+        await resp.prepare(request)
+        for offset in range(start, end + 1, _PART):
+            part = self._content(file, offset, min(offset + _PART, end + 1) - 1)
+            await self._pace(len(part))
+            await resp.write(part)
+        await resp.write_eof()
+        return resp
+
+    async def _directory(self, request: web.Request) -> web.Response:
+        parent = self._file(request, "dir")
+        name = (await request.json())["name"]
+        folder = self.add_folder(next(self._ids), name, parent_id=parent.id)
+        return web.json_response({"result": "success", "data": folder.item(self.report_hash)})
+
+    async def _upload(self, request: web.Request) -> web.Response:
+        query = request.query
+        parent_id = int(query["directory_id"])
+        if parent_id not in self.files:
+            raise web.HTTPNotFound()
+        data, size, sha256 = await self._read_body(request)
+        if size != int(query["total_size"]):
+            return _error(400, "wrong_size")
+        file = self._store(query["file_name"], parent_id, data, size, sha256, query.get("conflict", "error"))
+        return web.json_response({"result": "success", "data": file.item(self.report_hash)})
+
+    async def _session_start(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        token = f"session-{next(self._ids)}"
+        self.sessions[token] = {**payload, "chunks": {}}
+        return web.json_response({"result": "success", "data": {"token": token, "upload_url": self.url}})
+
+    def _session(self, request: web.Request) -> Dict[str, Any]:
+        session = self.sessions.get(request.match_info["token"])
+        if session is None:
+            raise web.HTTPNotFound()
+        return session
+
+    async def _session_chunk(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        number = int(request.query["chunk_number"])
+        data, size, sha256 = await self._read_body(request)
+        if size != int(request.query["chunk_size"]) or request.query["chunk_hash"] != f"sha256:{sha256}":
+            return _error(400, "chunk_mismatch")
+        session["chunks"][number] = (data, size)
+        return web.json_response({"result": "success", "data": {"number": number}})
+
+    async def _session_finish(self, request: web.Request) -> web.Response:
+        session = self._session(request)
+        chunks = session["chunks"]
+        if sorted(chunks) != list(range(1, session["total_chunks"] + 1)):
+            return _error(400, "missing_chunks")
+        size = sum(length for _, length in chunks.values())
+        if size != session["total_size"]:
+            return _error(400, "wrong_size")
+        data = None
+        sha256 = request.query.get("total_chunk_hash", "").removeprefix("sha256:")
+        if self.keep_data:
+            data = b"".join(chunks[n][0] for n in sorted(chunks))
+            if hashlib.sha256(data).hexdigest() != sha256:
+                return _error(400, "hash_mismatch")
+        file = self._store(session["file_name"], int(session["directory_id"]), data, size, sha256)
+        del self.sessions[request.match_info["token"]]
+        return web.json_response({"result": "success", "data": {"token": request.match_info["token"], "file": file.item(self.report_hash)}})
+
+    async def _session_cancel(self, request: web.Request) -> web.Response:
+        self._session(request)
+        del self.sessions[request.match_info["token"]]
+        return web.json_response({"result": "success", "data": True})
+
+    async def _delete(self, request: web.Request) -> web.Response:
+        file = self.files.pop(int(request.match_info["file_id"]), None)
+        if file is None:
+            raise web.HTTPNotFound()
+        self.trash[file.id] = file
+        return web.json_response({"result": "success", "data": True})
+
+    async def _purge(self, request: web.Request) -> web.Response:
+        if self.trash.pop(int(request.match_info["file_id"]), None) is None:
+            raise web.HTTPNotFound()
+        return web.json_response({"result": "success", "data": True})
+
+
+def _error(status: int, code: str, retry_after: Optional[str] = None) -> web.Response:
+    headers = {"Retry-After": retry_after} if retry_after is not None else None
+    return web.json_response({"result": "error", "error": {"code": code}}, status=status, headers=headers)
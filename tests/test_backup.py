@@ -0,0 +1,264 @@
+"""End-to-end tests of the backup agent against the fake server."""
+from __future__ import annotations
+
+import json
+from typing import Any
+
+import pytest
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+
+from homeassistant.components.backup import AgentBackup
+
+from custom_components.infomaniak_kdrive.backup import KDriveBackupAgent, create_catalog
+from custom_components.infomaniak_kdrive.client import KDriveClient
+from custom_components.infomaniak_kdrive.const import (
+    CONF_COMPRESSION,
+    CONF_ENCRYPTION_KEY,
+    CONF_INCREMENTAL,
+    CONF_KEEP_DAILY,
+    CONF_MAX_TOTAL_SIZE,
+    DOMAIN,
+    INDEX_FILENAME,
+)
+from custom_components.infomaniak_kdrive.dedup import ChunkStore
+from custom_components.infomaniak_kdrive.index import BackupIndex
+from custom_components.infomaniak_kdrive.integrity import async_verify_backups
+
+from .common import collect, opener, random_bytes
+from .fake_kdrive import DRIVE_ID, FOLDER_ID, TOKEN
+
+MIRROR_FOLDER_ID = 777
+
+
+def make_backup(backup_id: str, size: int, date: str = "2026-03-01T10:00:00+00:00", protected: bool = False) -> AgentBackup:
+    return AgentBackup(
+        addons=[],
+        backup_id=backup_id,
+        date=date,
+        database_included=True,
+        extra_metadata={},
+        folders=[],
+        homeassistant_included=True,
+        homeassistant_version="2026.3.0",
+        name=f"Backup {backup_id}",
+        protected=protected,
+        size=size,
+    )
+
+
+@pytest.fixture
+async def make_agent(hass, kdrive, make_client):
+    def make(options: dict[str, Any] | None = None, mirror: bool = False) -> KDriveBackupAgent:
+        options = options or {}
+        entry = MockConfigEntry(
+            domain=DOMAIN,
+            title="kDrive",
+            data={"token": TOKEN, "drive_id": DRIVE_ID, "folder_id": FOLDER_ID},
+            options=options,
+            version=5,
+            minor_version=2,
+        )
+        entry.add_to_hass(hass)
+        client = make_client(
+            compression=options.get(CONF_COMPRESSION, False),
+            encryption_key=options.get(CONF_ENCRYPTION_KEY),
+        )
+        mirror_client = None
+        if mirror:
+            kdrive.add_folder(MIRROR_FOLDER_ID, "mirror", parent_id=1)
+            mirror_client = KDriveClient(hass, TOKEN, DRIVE_ID, MIRROR_FOLDER_ID, api_url=kdrive.url)
+        index = BackupIndex(client)
+        return KDriveBackupAgent(
+            hass=hass,
+            entry=entry,
+            client=client,
+            catalog=create_catalog(hass, entry, client, index),
+            index=index,
+            chunk_store=ChunkStore(hass, client, f"{DOMAIN}.chunks_{entry.entry_id}"),
+            mirror=mirror_client,
+        )
+
+    return make
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {CONF_COMPRESSION: True},
+        {CONF_COMPRESSION: True, CONF_ENCRYPTION_KEY: "secret"},
+        {CONF_INCREMENTAL: True},
+    ],
+)
+async def test_upload_list_download_delete(make_agent, kdrive, options) -> None:
+    agent = make_agent(options)
+    data = random_bytes(200_000)
+    backup = make_backup("abc123", len(data))
+
+    await agent.async_upload_backup(open_stream=opener(data), backup=backup)
+
+    assert [b.backup_id for b in await agent.async_list_backups()] == ["abc123"]
+    assert (await agent.async_get_backup("abc123")).name == backup.name
+    assert await collect(await agent.async_download_backup("abc123")) == data
+
+    await agent.async_delete_backup("abc123")
+
+    assert await agent.async_list_backups() == []
+    names = {f.name for f in kdrive.children(FOLDER_ID) if f.type == "file"}
+    assert names == {INDEX_FILENAME}
+    assert not kdrive.trash
+
+
+async def test_filename_carries_the_transforms(make_agent, kdrive) -> None:
+    agent = make_agent({CONF_COMPRESSION: True, CONF_ENCRYPTION_KEY: "secret"})
+    await agent.async_upload_backup(open_stream=opener(b"data"), backup=make_backup("abc123", 4))
+
+    name = next(f.name for f in kdrive.children(FOLDER_ID) if f.name != INDEX_FILENAME)
+    assert "__id-abc123__" in name
+    assert name.endswith("__xf-zstd+aesgcm.tar")
+
+
+async def test_protected_backups_are_not_transformed(make_agent, kdrive) -> None:
+    agent = make_agent({CONF_COMPRESSION: True})
+    data = random_bytes(1000)
+    await agent.async_upload_backup(open_stream=opener(data), backup=make_backup("abc123", len(data), protected=True))
+
+    file = next(f for f in kdrive.children(FOLDER_ID) if f.name != INDEX_FILENAME)
+    assert "__xf-" not in file.name
+    assert file.data == data
+
+
+async def test_index_records_the_upload(make_agent, kdrive) -> None:
+    agent = make_agent()
+    data = random_bytes(1000)
+    await agent.async_upload_backup(open_stream=opener(data), backup=make_backup("abc123", len(data)))
+
+    index = json.loads(kdrive.by_name(INDEX_FILENAME).data)
+    record = index["backups"]["abc123"]
+    stored = next(f for f in kdrive.children(FOLDER_ID) if f.name != INDEX_FILENAME)
+    assert record["file_name"] == stored.name
+    assert record["sha256"] == stored.sha256
+    assert record["size"] == len(data)
+
+
+async def test_unreadable_index_is_not_overwritten(make_agent, kdrive) -> None:
+    kdrive.add_file(INDEX_FILENAME, b"{not json")
+    agent = make_agent()
+
+    await agent.async_upload_backup(open_stream=opener(b"data"), backup=make_backup("abc123", 4))
+
+    assert kdrive.by_name(INDEX_FILENAME).data == b"{not json"
+    # Listing falls back to the filenames
+    assert [b.backup_id for b in await agent.async_list_backups()] == ["abc123"]
+
+
+async def test_listing_during_the_index_update_is_not_reused(make_agent, kdrive) -> None:
+    agent = make_agent()
+    put = agent._index.async_put
+
+    async def put_after_listing(*args, **kwargs) -> None:
+        # The file is there, the index does not know it yet
+        await agent.async_list_backups()
+        await put(*args, **kwargs)
+
+    agent._index.async_put = put_after_listing
+    await agent.async_upload_backup(open_stream=opener(b"data"), backup=make_backup("abc123", 4))
+
+    assert (await agent.async_get_backup("abc123")).name == "Backup abc123"
+
+
+async def test_unchanged_listing_does_not_read_the_index(make_agent, kdrive) -> None:
+    agent = make_agent()
+    await agent.async_upload_backup(open_stream=opener(b"data"), backup=make_backup("abc123", 4))
+    await agent.async_list_backups()
+    downloads = kdrive.count("download")
+
+    agent._catalog.invalidate()
+    await agent.async_list_backups()
+    assert kdrive.count("download") == downloads
+
+    # A rewritten index is read again
+    kdrive.by_name(INDEX_FILENAME).last_modified_at += 1
+    agent._catalog.invalidate()
+    await agent.async_list_backups()
+    assert kdrive.count("download") == downloads + 1
+
+
+async def test_verification_reports_changed_files(make_agent, kdrive) -> None:
+    agent = make_agent()
+    for backup_id in ("one", "two", "three"):
+        await agent.async_upload_backup(open_stream=opener(backup_id.encode()), backup=make_backup(backup_id, len(backup_id)))
+    files = {f.name.partition("__id-")[2].partition("__")[0]: f for f in kdrive.children(FOLDER_ID)}
+    files["two"].sha256 = "0" * 64
+    kdrive.files.pop(files["three"].id)
+
+    result = await async_verify_backups(agent._client, agent._index)
+
+    assert result["verified"] == 1
+    assert result["mismatched"] == [files["two"].name]
+    assert result["missing"] == [files["three"].name]
+
+
+async def test_incremental_backups_share_chunks(make_agent, kdrive) -> None:
+    agent = make_agent({CONF_INCREMENTAL: True})
+    shared = random_bytes(3 * 1024 * 1024, seed=1)
+    first = shared + random_bytes(100_000, seed=2)
+    second = shared + random_bytes(100_000, seed=3)
+    await agent.async_upload_backup(open_stream=opener(first), backup=make_backup("first", len(first)))
+    uploads = kdrive.count("upload")
+
+    await agent.async_upload_backup(open_stream=opener(second), backup=make_backup("second", len(second)))
+    # Recipe, index and the chunks past the shared part
+    assert kdrive.count("upload") - uploads <= 5
+
+    await agent.async_delete_backup("first")
+
+    assert await collect(await agent.async_download_backup("second")) == second
+
+
+async def test_retention_keeps_one_backup_a_day(make_agent, kdrive) -> None:
+    agent = make_agent({CONF_KEEP_DAILY: 2})
+    dates = ["2026-03-01T08:00:00+00:00", "2026-03-02T08:00:00+00:00", "2026-03-02T20:00:00+00:00"]
+    for i, date in enumerate(dates):
+        await agent.async_upload_backup(open_stream=opener(b"data"), backup=make_backup(f"b{i}", 4, date=date))
+
+    assert sorted(b.backup_id for b in await agent.async_list_backups()) == ["b0", "b2"]
+
+
+async def test_total_size_counts_the_stored_files(make_agent, kdrive) -> None:
+    # Three 600 kB archives that compress to almost nothing stay under 1 MiB
+    agent = make_agent({CONF_COMPRESSION: True, CONF_MAX_TOTAL_SIZE: 1 / 1024})
+    for i in range(3):
+        data = bytes(600_000)
+        await agent.async_upload_backup(
+            open_stream=opener(data), backup=make_backup(f"b{i}", len(data), date=f"2026-03-0{i + 1}T08:00:00+00:00"),
+        )
+
+    assert len(await agent.async_list_backups()) == 3
+
+
+async def test_mirrored_upload(make_agent, kdrive) -> None:
+    agent = make_agent({CONF_COMPRESSION: True}, mirror=True)
+    data = random_bytes(100_000)
+
+    await agent.async_upload_backup(open_stream=opener(data), backup=make_backup("abc123", len(data)))
+
+    primary = next(f for f in kdrive.children(FOLDER_ID) if f.name != INDEX_FILENAME)
+    mirrored = kdrive.by_name(primary.name, MIRROR_FOLDER_ID)
+    assert mirrored is not None
+    assert mirrored.sha256 == primary.sha256
+
+    await agent.async_delete_backup("abc123")
+
+    assert kdrive.children(MIRROR_FOLDER_ID) == []
+    await agent._mirror.async_close()
+
+
+async def test_mirror_failure_does_not_fail_the_upload(make_agent, kdrive) -> None:
+    agent = make_agent(mirror=True)
+    kdrive.files.pop(MIRROR_FOLDER_ID)  # uploads to the mirror answer 404
+
+    await agent.async_upload_backup(open_stream=opener(b"data"), backup=make_backup("abc123", 4))
+
+    assert [b.backup_id for b in await agent.async_list_backups()] == ["abc123"]
+    await agent._mirror.async_close()
@@ -0,0 +1,157 @@
+"""Transfer benchmark against the fake server, opt-in.
+
+    KDRIVE_BENCH=10M,100M,1G,10G pytest tests/test_benchmark.py -s
+
+reports, per backup size, the upload and download throughput, the peak
+RSS of the process and the event-loop lag (worst and 99th percentile
+delay of a 10 ms timer) during the transfer. KDRIVE_BENCH_LATENCY
+(seconds per request) and KDRIVE_BENCH_BANDWIDTH (bytes/s) shape the fake
+link; KDRIVE_BENCH_CONCURRENCY sets the upload and download concurrency.
+The same sizes also run the transform stage alone (zstd, zstd+aesgcm) and
+report its throughput and the share of bytes it saves, on content that is
+half random, half text, like a backup of compressed add-ons and a database.
+KDRIVE_BENCH_FILES (default 1000,10000) sets the folder sizes of the
+listing benchmark: a full listing and an early exit after the first item.
+The fake server does not keep the content, downloads serve filler bytes.
+It runs in the same process and event loop, so RSS and lag include its
+share of the work: compare runs with each other, not with production.
+"""
+from __future__ import annotations
+
+import os
+import time
+from typing import AsyncIterator
+
+import pytest
+
+from custom_components.infomaniak_kdrive.const import DEFAULT_UPLOAD_CONCURRENCY, XF_AESGCM, XF_ZSTD
+from custom_components.infomaniak_kdrive.transform import apply_transforms
+
+from .common import probe, random_bytes
+
+SIZES = [s for s in os.environ.get("KDRIVE_BENCH", "").split(",") if s]
+FILES = [int(n) for n in os.environ.get("KDRIVE_BENCH_FILES", "1000,10000").split(",") if n]
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# Distinct blocks cycled through by mixed(), more than the zstd window apart
+MIXED_BLOCKS = 64
+
+pytestmark = pytest.mark.skipif(not SIZES, reason="set KDRIVE_BENCH=10M,100M,... to run")
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    if value[-1:] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+async def source(size: int) -> AsyncIterator[bytes]:
+    block = os.urandom(1024 * 1024)
+    sent = 0
+    while sent < size:
+        part = block[:min(len(block), size - sent)]
+        sent += len(part)
+        yield part
+
+
+@pytest.mark.parametrize("files", FILES)
+async def test_listing(client, kdrive, capsys, files: int) -> None:
+    kdrive.latency = float(os.environ.get("KDRIVE_BENCH_LATENCY", 0))
+    for i in range(files):
+        kdrive.add_file(f"backup-{i}.tar", b"x")
+
+    start = time.monotonic()
+    assert len(await client.list_folder_files()) == files
+    full = time.monotonic() - start
+    pages = kdrive.count("list")
+
+    start = time.monotonic()
+    async for _ in client.iter_folder_files():
+        break
+    first = time.monotonic() - start
+
+    with capsys.disabled():
+        print(
+            f"\n{files:>6} files  full listing {full * 1000:8.1f} ms ({pages} pages)"
+            f"  first item {first * 1000:7.1f} ms"
+        )
+
+
+def mixed_blocks() -> list[bytes]:
+    blocks = []
+    for i in range(MIXED_BLOCKS):
+        text = "".join(
+            f'{{"entity_id":"sensor.t{n % 500}","state":"{(n * 7919 + i) % 100000 / 100}"}}\n'
+            for n in range(i * 20000, (i + 1) * 20000)
+        ).encode()
+        blocks.append((random_bytes(512 * 1024, seed=i) + text)[:1024 * 1024])
+    return blocks
+
+
+async def mixed(size: int, blocks: list[bytes]) -> AsyncIterator[bytes]:
+    sent = 0
+    i = 0
+    while sent < size:
+        part = blocks[i % len(blocks)][:size - sent]
+        sent += len(part)
+        i += 1
+        yield part
+
+
+@pytest.mark.parametrize("transforms", [[XF_ZSTD], [XF_ZSTD, XF_AESGCM]], ids=["zstd", "zstd+aesgcm"])
+@pytest.mark.parametrize("size", SIZES)
+async def test_transforms(hass, capsys, size: str, transforms: list[str]) -> None:
+    total = parse_size(size)
+    blocks = mixed_blocks()
+
+    async with probe() as stage:
+        start = time.monotonic()
+        stored = 0
+        async for part in apply_transforms(hass, mixed(total, blocks), transforms, "benchmark"):
+            stored += len(part)
+        duration = time.monotonic() - start
+        report = stage.report()
+
+    with capsys.disabled():
+        print(
+            f"\n{size:>6} {'+'.join(transforms):<12} {total / duration / 1024 ** 2:8.1f} MiB/s"
+            f"  saved {100 * (1 - stored / total):5.1f}%"
+            f"  peak RSS {report['peak_rss_mb']:7.1f} MiB"
+            f"  loop lag max {report['lag_max_ms']:6.1f} ms"
+        )
+
+
+@pytest.mark.parametrize("size", SIZES)
+async def test_transfer(make_client, kdrive, capsys, size: str) -> None:
+    total = parse_size(size)
+    kdrive.keep_data = False
+    kdrive.latency = float(os.environ.get("KDRIVE_BENCH_LATENCY", 0))
+    kdrive.bandwidth = float(os.environ.get("KDRIVE_BENCH_BANDWIDTH", 0)) or None
+    concurrency = int(os.environ.get("KDRIVE_BENCH_CONCURRENCY", DEFAULT_UPLOAD_CONCURRENCY))
+    client = make_client(upload_concurrency=concurrency, download_concurrency=concurrency)
+
+    async def open_stream() -> AsyncIterator[bytes]:
+        return source(total)
+
+    rows = []
+    async with probe() as up:
+        start = time.monotonic()
+        stored = await client.upload_stream_to_folder(filename=f"bench-{size}.tar", open_stream=open_stream, size_hint=total)
+        rows.append(("upload", time.monotonic() - start, up.report()))
+    assert stored["size"] == total
+
+    async with probe() as down:
+        start = time.monotonic()
+        received = 0
+        async for part in client.download_file_stream(stored["file"]["id"], size=total):
+            received += len(part)
+        rows.append(("download", time.monotonic() - start, down.report()))
+    assert received == total
+
+    with capsys.disabled():
+        for kind, duration, report in rows:
+            print(
+                f"\n{size:>6} {kind:<8} {total / duration / 1024 ** 2:8.1f} MiB/s"
+                f"  peak RSS {report['peak_rss_mb']:7.1f} MiB"
+                f"  loop lag max {report['lag_max_ms']:6.1f} ms, p99 {report['lag_p99_ms']:6.1f} ms"
+            )
@@ -0,0 +1,89 @@
+"""Tests for the backup catalog cache."""
+from __future__ import annotations
+
+import asyncio
+
+from homeassistant.helpers.storage import Store
+
+from custom_components.infomaniak_kdrive.catalog import BackupCatalog
+
+KEY = "infomaniak_kdrive.catalog_test"
+
+
+class Entry(str):
+    # Stands in for a CatalogEntry, the store saves it
+    def as_dict(self) -> dict:
+        return {}
+
+
+class Loader:
+    def __init__(self) -> None:
+        self.calls = 0
+        self.fail = False
+        self.result: dict = {}
+        self.previous: list = []
+        self.during = None
+
+    async def __call__(self, previous):
+        self.calls += 1
+        self.previous.append(previous)
+        if self.during is not None:
+            self.during()
+        if self.fail:
+            raise OSError("kDrive unreachable")
+        return dict(self.result)
+
+
+async def test_listing_is_shared_until_the_ttl(hass) -> None:
+    loader = Loader()
+    catalog = BackupCatalog(loader, ttl=60)
+
+    await asyncio.gather(*(catalog.async_entries() for _ in range(5)))
+    await catalog.async_entries()
+
+    assert loader.calls == 1
+    catalog.invalidate()
+    await catalog.async_entries()
+    assert loader.calls == 2
+
+
+async def test_invalidated_listing_is_not_reused(hass) -> None:
+    loader = Loader()
+    catalog = BackupCatalog(loader, ttl=60)
+    loader.result = {"abc": "partial"}
+    loader.during = catalog.invalidate
+
+    assert await catalog.async_entries() == {"abc": "partial"}  # served once
+
+    loader.during = None
+    await catalog.async_entries()
+    assert loader.previous == [None, None]
+
+
+async def test_snapshot_is_refreshed_after_a_failed_prefetch(hass, hass_storage) -> None:
+    hass_storage[KEY] = {"version": 1, "key": KEY, "data": {"entries": {}}}
+    loader = Loader()
+    loader.fail = True
+    catalog = BackupCatalog(loader, ttl=60, store=Store(hass, 1, KEY))
+
+    await catalog.async_prefetch()
+    assert await catalog.async_entries(allow_stale=True) == {}  # the snapshot
+
+    loader.fail = False
+    loader.result = {"abc": Entry("entry")}
+    await catalog.async_entries(allow_stale=True)  # starts a refresh
+    await hass.async_block_till_done()
+    await asyncio.sleep(0)
+
+    assert await catalog.async_entries(allow_stale=True) == {"abc": "entry"}
+    assert loader.calls == 2
+    await catalog.async_close()
+
+
+async def test_stale_entries_without_a_snapshot_wait_for_the_listing(hass, hass_storage) -> None:
+    loader = Loader()
+    loader.result = {"abc": Entry("entry")}
+    catalog = BackupCatalog(loader, ttl=60, store=Store(hass, 1, KEY))
+
+    assert await catalog.async_entries(allow_stale=True) == {"abc": "entry"}
+    assert loader.calls == 1
@@ -0,0 +1,324 @@
+"""Tests for the kDrive client against the fake server."""
+from __future__ import annotations
+
+import hashlib
+import math
+import time
+
+import aiohttp
+import pytest
+
+from custom_components.infomaniak_kdrive import client as client_module
+from custom_components.infomaniak_kdrive.client import KDriveClient
+from custom_components.infomaniak_kdrive.const import REQUEST_RETRIES, UPLOAD_SESSION_MAX_AGE
+
+from .common import collect, opener, probe, random_bytes
+from .fake_kdrive import FakeFile
+
+CHUNK = 64 * 1024
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Chunked uploads of a few hundred KiB, nothing goes direct
+    monkeypatch.setattr(client_module, "UPLOAD_CHUNK_SIZE", CHUNK)
+    monkeypatch.setattr(client_module, "DIRECT_UPLOAD_DEFAULT_SIZE", 0)
+
+
+async def test_list_follows_the_cursor(client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "LIST_PAGE_SIZE", 2)
+    for i in range(5):
+        kdrive.add_file(f"backup-{i}.tar", b"x")
+    kdrive.add_folder(789, "sub")
+
+    items = await client.list_folder_files()
+
+    assert sorted(it["name"] for it in items) == [f"backup-{i}.tar" for i in range(5)]
+    assert kdrive.count("list") == 3
+
+
+async def test_list_thousands_of_files(client, kdrive) -> None:
+    for i in range(2500):
+        kdrive.add_file(f"backup-{i}.tar", b"x")
+
+    items = await client.list_folder_files()
+
+    assert len({it["id"] for it in items}) == 2500
+    assert kdrive.count("list") == 3  # pages of 1000
+
+
+async def test_iteration_stops_early(client, kdrive) -> None:
+    first = kdrive.add_file("first.tar", b"x")
+    for i in range(2500):
+        kdrive.add_file(f"backup-{i}.tar", b"x")
+
+    async for item in client.iter_folder_files():
+        if item["id"] == first.id:
+            break
+
+    assert kdrive.count("list") == 1
+
+
+async def test_file_size_falls_back_to_a_range_request(client, kdrive) -> None:
+    file = kdrive.add_file("a.tar", b"x" * 1234)
+    kdrive.head = False
+
+    assert await client.get_file_size(file.id) == 1234
+    assert kdrive.count("download", "GET") == 1
+
+
+async def test_direct_upload(client, kdrive) -> None:
+    data = random_bytes(300 * 1024)
+    progress = []
+
+    stored = await client.upload_stream_to_folder(
+        filename="a.tar", open_stream=opener(data), size_hint=len(data), on_progress=progress.append,
+    )
+
+    assert kdrive.by_name("a.tar").data == data
+    assert stored["size"] == len(data)
+    assert stored["file"]["id"] == kdrive.by_name("a.tar").id
+    assert progress[-1] == len(data)
+    assert kdrive.count("upload") == 1
+    assert kdrive.count("session_start") == 0
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_chunked_upload(make_client, kdrive) -> None:
+    client = make_client(upload_concurrency=4)
+    kdrive.latency = 0.01
+    data = random_bytes(10 * CHUNK + 123)
+    progress = []
+
+    stored = await client.upload_stream_to_folder(
+        filename="a.tar", open_stream=opener(data), size_hint=len(data), on_progress=progress.append,
+    )
+
+    assert kdrive.by_name("a.tar").data == data
+    assert stored["sha256"] == kdrive.by_name("a.tar").sha256
+    assert kdrive.count("chunk") == 11
+    assert 1 < kdrive.peak_in_flight["chunk"] <= 4
+    assert progress[-1] == len(data)
+    assert not kdrive.sessions
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_concurrent_chunks_speed_up_the_upload(make_client, kdrive) -> None:
+    # 50 ms per request: 16 chunks take 0.8 s one at a time, 0.2 s four at
+    # a time. Session start and finish add 0.1 s either way.
+    kdrive.latency = 0.05
+    data = random_bytes(16 * CHUNK)
+    durations = {}
+    for concurrency in (1, 4):
+        client = make_client(upload_concurrency=concurrency)
+        start = time.monotonic()
+        await client.upload_stream_to_folder(filename=f"{concurrency}.tar", open_stream=opener(data), size_hint=len(data))
+        durations[concurrency] = time.monotonic() - start
+
+    assert durations[1] / durations[4] > 2
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_chunked_upload_caps_buffered_bytes(make_client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "UPLOAD_MAX_BUFFER", 2 * CHUNK)
+    client = make_client(upload_concurrency=8)
+    kdrive.latency = 0.01
+    data = random_bytes(10 * CHUNK)
+
+    await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+
+    assert kdrive.peak_in_flight["chunk"] == 2
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_chunk_retried_after_transient_error(client, kdrive) -> None:
+    data = random_bytes(4 * CHUNK)
+    kdrive.fail("chunk", 503, count=2)
+
+    await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+
+    assert kdrive.by_name("a.tar").data == data
+    assert client.stats.retries == 2
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_failed_upload_resumes_from_acked_chunks(make_client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "UPLOAD_CHUNK_RETRIES", 1)
+    client = make_client(upload_concurrency=1)
+    data = random_bytes(6 * CHUNK)
+    kdrive.fail("chunk", 503, count=2, skip=3)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+    assert len(kdrive.sessions) == 1
+    assert kdrive.count("chunk") == 5
+
+    await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+
+    assert kdrive.by_name("a.tar").data == data
+    assert kdrive.count("session_start") == 1
+    assert kdrive.count("chunk") == 5 + 3  # chunks 1-3 are not sent again
+    assert await client._journal.async_get("a.tar") is None
+
+
+@pytest.mark.usefixtures("small_chunks")
+@pytest.mark.parametrize("failing", ["chunk", "finish"])
+async def test_session_dropped_by_kdrive_is_replaced(make_client, kdrive, monkeypatch, failing) -> None:
+    monkeypatch.setattr(client_module, "UPLOAD_CHUNK_RETRIES", 1)
+    client = make_client(upload_concurrency=1)
+    data = random_bytes(6 * CHUNK)
+    if failing == "chunk":
+        kdrive.fail("chunk", 503, count=2, skip=3)
+    else:
+        monkeypatch.setattr(client_module, "CIRCUIT_OPEN_TIME", 0)
+        kdrive.fail("finish", 503, count=REQUEST_RETRIES + 1)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+    kdrive.sessions.clear()  # expired on the kDrive side
+
+    await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+
+    assert kdrive.by_name("a.tar").data == data
+    assert kdrive.count("session_start") == 2
+    assert not kdrive.sessions
+    assert await client._journal.async_get("a.tar") is None
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_encrypted_upload_does_not_resume(make_client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "UPLOAD_CHUNK_RETRIES", 1)
+    client = make_client(upload_concurrency=1, encryption_key="secret")
+    data = random_bytes(6 * CHUNK)
+    kdrive.fail("chunk", 503, count=2, skip=3)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await client.upload_stream_to_folder(
+            filename="a.tar", open_stream=opener(data), transforms=client.transforms,
+        )
+    await client.upload_stream_to_folder(
+        filename="a.tar", open_stream=opener(data), transforms=client.transforms,
+    )
+
+    assert kdrive.count("session_start") == 2
+    assert not kdrive.sessions
+    restored = await collect(client.download_file_stream(kdrive.by_name("a.tar").id, transforms=client.transforms))
+    assert restored == data
+
+
+@pytest.mark.usefixtures("small_chunks")
+async def test_rejected_chunk_cancels_the_session(client, kdrive) -> None:
+    data = random_bytes(3 * CHUNK)
+    kdrive.fail("chunk", 400)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+
+    assert not kdrive.sessions
+    assert kdrive.count("cancel") == 1
+    assert await client._journal.async_get("a.tar") is None
+
+
+@pytest.mark.parametrize("spooled", [False, True])
+async def test_loop_stays_responsive_during_an_upload(make_client, kdrive, monkeypatch, tmp_path, spooled) -> None:
+    # Spooling, reading back and hashing 16 MiB chunks run in the executor:
+    # done on the loop, they hold it for 200 ms and more
+    monkeypatch.setattr(client_module, "UPLOAD_CHUNK_SIZE", 16 * 1024 * 1024)
+    monkeypatch.setattr(client_module, "DIRECT_UPLOAD_DEFAULT_SIZE", 0)
+    monkeypatch.setattr(client_module, "SPOOL_DIR", str(tmp_path))
+    kdrive.keep_data = False  # the server would join and hash the file on the loop
+    client = make_client()
+    data = random_bytes(64 * 1024 * 1024)
+
+    async with probe() as lag:
+        await client.upload_stream_to_folder(
+            filename="a.tar", open_stream=opener(data, 1024 * 1024), size_hint=None if spooled else len(data),
+        )
+
+    assert kdrive.by_name("a.tar").sha256 == hashlib.sha256(data).hexdigest()
+    assert list(tmp_path.iterdir()) == []
+    assert lag.report()["lag_max_ms"] < 150
+
+
+async def test_expired_sessions_are_cancelled(client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "UPLOAD_CHUNK_SIZE", CHUNK)
+    kdrive.sessions["old"] = {"chunks": {}}
+    kdrive.sessions["recent"] = {"chunks": {}}
+    for name, token in (("old.tar", "old"), ("recent.tar", "recent")):
+        await client._journal.async_start(name, token=token, upload_url=kdrive.url, chunk_size=CHUNK, total_size=CHUNK)
+    (await client._journal.async_get("old.tar"))["started_at"] = time.time() - UPLOAD_SESSION_MAX_AGE - 1
+
+    await client.async_cancel_expired_sessions()
+
+    assert list(kdrive.sessions) == ["recent"]
+    assert await client._journal.async_get("old.tar") is None
+    assert await client._journal.async_get("recent.tar") is not None
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("sha256:" + "AB" * 32, "ab" * 32),
+        ("ab" * 32, None),  # untagged, the algorithm is unknown
+        ("md5:" + "ab" * 16, None),
+        ("sha256:abc", None),
+        (None, None),
+    ],
+)
+def test_remote_sha256(value, expected) -> None:
+    assert KDriveClient.remote_sha256({"hash": value}) == expected
+
+
+async def test_mismatching_server_hash_keeps_the_upload(client, kdrive, monkeypatch) -> None:
+    data = random_bytes(1000)
+    item = FakeFile.item
+
+    def tampered(self, report_hash):
+        return {**item(self, report_hash), "hash": "sha256:" + "0" * 64}
+
+    monkeypatch.setattr(FakeFile, "item", tampered)
+
+    stored = await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+
+    assert kdrive.by_name("a.tar").data == data
+    assert stored["sha256"] != "0" * 64
+    assert kdrive.count("delete") == 0
+
+
+async def test_ranged_download(make_client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "DOWNLOAD_RANGE_SIZE", CHUNK)
+    client = make_client(download_concurrency=4)
+    data = random_bytes(5 * CHUNK + 17)
+    file = kdrive.add_file("a.tar", data)
+    kdrive.latency = 0.01
+    kdrive.fail("download", 503, skip=2)
+
+    restored = await collect(client.download_file_stream(file.id, size=len(data)))
+
+    assert restored == data
+    assert kdrive.count("download") == math.ceil(len(data) / CHUNK) + 1
+    assert 1 < kdrive.peak_in_flight["download"] <= 5
+
+
+async def test_download_without_range_support(make_client, kdrive, monkeypatch) -> None:
+    monkeypatch.setattr(client_module, "DOWNLOAD_RANGE_SIZE", CHUNK)
+    client = make_client(download_concurrency=4)
+    data = random_bytes(3 * CHUNK)
+    file = kdrive.add_file("a.tar", data)
+    kdrive.ranges = False
+
+    assert await collect(client.download_file_stream(file.id, size=len(data))) == data
+
+
+async def test_delete_files(client, kdrive) -> None:
+    gone = kdrive.add_file("gone.tar", b"x")
+    kept = kdrive.add_file("kept.tar", b"x")
+
+    # Already missing counts as deleted
+    assert await client.delete_files([gone.id, 999]) == []
+    assert gone.id not in kdrive.files
+    assert gone.id not in kdrive.trash
+
+    kdrive.fail("delete", 403)
+    assert await client.delete_files([kept.id]) == [kept.id]
+    assert kept.id in kdrive.files
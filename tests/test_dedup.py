@@ -0,0 +1,120 @@
+"""Tests for content-defined chunking and the chunk store."""
+from __future__ import annotations
+
+import aiohttp
+import pytest
+
+from custom_components.infomaniak_kdrive import dedup
+from custom_components.infomaniak_kdrive.const import CHUNK_STORE_FOLDER
+from custom_components.infomaniak_kdrive.dedup import ChunkStore, split_content_defined
+
+from .common import collect, iter_bytes, random_bytes
+from .fake_kdrive import FOLDER_ID
+
+MIN, MAX = 1024, 8 * 1024
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # Cuts on a one-byte marker, about every 256 bytes past the minimum
+    monkeypatch.setattr(dedup, "CDC_MIN_SIZE", MIN)
+    monkeypatch.setattr(dedup, "CDC_MAX_SIZE", MAX)
+    monkeypatch.setattr(dedup, "CDC_MARKER", b"\x8f")
+
+
+async def chunks_of(data: bytes, part: int = 3000) -> list[bytes]:
+    return [chunk async for chunk in split_content_defined(iter_bytes(data, part))]
+
+
+async def test_split_covers_the_input() -> None:
+    data = random_bytes(500_000)
+    chunks = await chunks_of(data)
+
+    assert b"".join(chunks) == data
+    assert all(MIN <= len(chunk) <= MAX for chunk in chunks[:-1])
+    assert len(chunks[-1]) <= MAX
+
+
+async def test_split_does_not_depend_on_read_sizes() -> None:
+    data = random_bytes(200_000)
+    assert await chunks_of(data, 100) == await chunks_of(data, 70_000)
+
+
+async def test_split_without_marker_cuts_at_max_size() -> None:
+    chunks = await chunks_of(b"\x00" * (3 * MAX + 5))
+    assert [len(chunk) for chunk in chunks] == [MAX, MAX, MAX, 5]
+
+
+async def test_insertion_only_changes_nearby_chunks() -> None:
+    data = random_bytes(500_000)
+    before = await chunks_of(data)
+    after = await chunks_of(data[:1000] + b"inserted" + data[1000:])
+
+    assert len(set(before) - set(after)) <= 2
+
+
+@pytest.fixture
+async def store(hass, client) -> ChunkStore:
+    return ChunkStore(hass, client, "infomaniak_kdrive.chunks_test")
+
+
+async def test_upload_and_restore(store, kdrive) -> None:
+    data = random_bytes(100_000)
+
+    stored = await store.async_upload(iter_bytes(data), "backup.tar")
+
+    recipe = kdrive.by_name("backup.tar")
+    assert stored["file"]["id"] == recipe.id
+    assert stored["size"] == recipe.size
+    folder = kdrive.by_name(CHUNK_STORE_FOLDER)
+    assert folder.type == "dir"
+    assert len(kdrive.children(folder.id)) == len(await chunks_of(data))
+    assert await collect(store.async_download(recipe.id)) == data
+
+
+async def test_unchanged_chunks_are_uploaded_once(store, kdrive) -> None:
+    data = random_bytes(100_000)
+    await store.async_upload(iter_bytes(data), "first.tar")
+    uploads = kdrive.count("upload")
+
+    await store.async_upload(iter_bytes(data[:50_000] + b"changed" + data[50_000:]), "second.tar")
+
+    # The recipe and the chunks around the change
+    assert kdrive.count("upload") - uploads <= 4
+
+
+async def test_same_backup_uploaded_again(store, kdrive) -> None:
+    data = random_bytes(100_000)
+    await store.async_upload(iter_bytes(data), "backup.tar")
+
+    stored = await store.async_upload(iter_bytes(data), "backup.tar")
+
+    assert stored["file"]["id"] == kdrive.by_name("backup.tar").id
+    assert await collect(store.async_download(stored["file"]["id"])) == data
+
+
+async def test_garbage_collection(store, kdrive) -> None:
+    shared = random_bytes(50_000, seed=1)
+    first = shared + random_bytes(50_000, seed=2)
+    second = shared + random_bytes(50_000, seed=3)
+    await store.async_upload(iter_bytes(first), "first.tar")
+    await store.async_upload(iter_bytes(second), "second.tar")
+    folder = kdrive.by_name(CHUNK_STORE_FOLDER)
+    kdrive.files.pop(kdrive.by_name("first.tar").id)
+
+    async def list_recipes() -> list[int]:
+        return [f.id for f in kdrive.children(FOLDER_ID) if f.name.endswith(".tar")]
+
+    await store.async_collect_garbage(list_recipes)
+
+    assert len(kdrive.children(folder.id)) == len(set(await chunks_of(second)))
+    assert await collect(store.async_download(kdrive.by_name("second.tar").id)) == second
+
+
+async def test_missing_chunk_fails_the_restore(store, kdrive) -> None:
+    await store.async_upload(iter_bytes(random_bytes(50_000)), "backup.tar")
+    folder = kdrive.by_name(CHUNK_STORE_FOLDER)
+    kdrive.files.pop(kdrive.children(folder.id)[0].id)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await collect(store.async_download(kdrive.by_name("backup.tar").id))
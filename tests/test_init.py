@@ -0,0 +1,45 @@
+"""Tests for the config entry setup."""
+from __future__ import annotations
+
+from pytest_homeassistant_custom_component.common import MockConfigEntry
+
+from custom_components.infomaniak_kdrive import async_migrate_entry
+from custom_components.infomaniak_kdrive.const import CONF_AGENT_ID, DOMAIN, LEGACY_AGENT_ID
+
+
+def make_entry(hass, folder_id: int, minor_version: int = 1) -> MockConfigEntry:
+    entry = MockConfigEntry(
+        domain=DOMAIN,
+        data={"token": "token", "drive_id": 1, "folder_id": folder_id},
+        version=5,
+        minor_version=minor_version,
+    )
+    entry.add_to_hass(hass)
+    return entry
+
+
+async def test_first_migrated_entry_keeps_the_legacy_agent_id(hass) -> None:
+    first = make_entry(hass, 1)
+    second = make_entry(hass, 2)
+
+    assert await async_migrate_entry(hass, first)
+    assert await async_migrate_entry(hass, second)
+
+    assert first.data[CONF_AGENT_ID] == LEGACY_AGENT_ID
+    assert CONF_AGENT_ID not in second.data
+    assert first.minor_version == second.minor_version == 2
+
+
+async def test_entries_created_since_do_not_hold_the_legacy_agent_id(hass) -> None:
+    make_entry(hass, 1, minor_version=2)
+    old = make_entry(hass, 2)
+
+    assert await async_migrate_entry(hass, old)
+    assert old.data[CONF_AGENT_ID] == LEGACY_AGENT_ID
+
+
+async def test_unknown_major_version(hass) -> None:
+    entry = MockConfigEntry(domain=DOMAIN, data={}, version=6)
+    entry.add_to_hass(hass)
+
+    assert not await async_migrate_entry(hass, entry)
@@ -0,0 +1,92 @@
+"""Tests for the retention policy."""
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from homeassistant.util import dt as dt_util
+
+from custom_components.infomaniak_kdrive.retention import (
+    RetentionItem,
+    RetentionPolicy,
+    select_deletions,
+)
+
+NOW = datetime(2026, 3, 15, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def time_zone():
+    # Days, weeks and months are local ones: UTC unless a test sets another
+    previous = dt_util.get_default_time_zone()
+    dt_util.set_default_time_zone(dt_util.UTC)
+    yield
+    dt_util.set_default_time_zone(previous)
+
+
+def daily(count: int, size: int = 1) -> list[RetentionItem]:
+    # One backup a day at noon, newest first: key 0 is today
+    return [RetentionItem(key=i, date=NOW - timedelta(days=i), size=size) for i in range(count)]
+
+
+def deleted(items: list[RetentionItem], policy: RetentionPolicy) -> list:
+    return [it.key for it in select_deletions(items, policy, NOW)]
+
+
+def test_disabled_policy_keeps_everything() -> None:
+    assert deleted(daily(10), RetentionPolicy()) == []
+
+
+def test_keep_last() -> None:
+    assert deleted(daily(5), RetentionPolicy(keep_last=2)) == [4, 3, 2]
+
+
+def test_keep_within_days() -> None:
+    assert deleted(daily(5), RetentionPolicy(keep_within_days=2)) == [4, 3]
+
+
+def test_keep_daily_keeps_the_newest_of_each_day() -> None:
+    items = daily(3) + [RetentionItem(key="early", date=NOW - timedelta(hours=6), size=1)]
+    assert deleted(items, RetentionPolicy(keep_daily=2)) == [2, "early"]
+
+
+def test_rules_add_up() -> None:
+    # Two most recent, plus one a week for four weeks (ISO weeks start on
+    # Monday; 2026-03-15 is a Sunday)
+    policy = RetentionPolicy(keep_last=2, keep_weekly=4)
+    kept = {it.key for it in daily(40)} - set(deleted(daily(40), policy))
+    assert kept == {0, 1, 7, 14, 21}
+
+
+def test_keep_monthly() -> None:
+    kept = {it.key for it in daily(100)} - set(deleted(daily(100), RetentionPolicy(keep_monthly=3)))
+    # Newest of March, February and January
+    assert kept == {0, 15, 43}
+
+
+def test_max_total_size_drops_the_oldest() -> None:
+    policy = RetentionPolicy(keep_last=5, max_total_size=30)
+    assert deleted(daily(5, size=10), policy) == [4, 3]
+
+
+def test_max_total_size_alone() -> None:
+    assert deleted(daily(4, size=10), RetentionPolicy(max_total_size=25)) == [3, 2]
+
+
+def test_newest_is_always_kept() -> None:
+    assert deleted(daily(2, size=100), RetentionPolicy(max_total_size=10)) == [1]
+    assert deleted(daily(1), RetentionPolicy(keep_within_days=1, max_total_size=0)) == []
+
+
+
+def test_days_are_local_whatever_the_offset() -> None:
+    dt_util.set_default_time_zone(dt_util.get_time_zone("Europe/Zurich"))
+    items = [
+        RetentionItem(key="morning", date=datetime.fromisoformat("2026-03-03T08:00:00+01:00"), size=1),
+        # 00:30 on March 3rd in Zurich, the same day as "morning"
+        RetentionItem(key="midnight", date=datetime.fromisoformat("2026-03-02T23:30:00+00:00"), size=1),
+        RetentionItem(key="previous_day", date=datetime.fromisoformat("2026-03-02T12:00:00+01:00"), size=1),
+    ]
+
+    assert deleted(items, RetentionPolicy(keep_daily=2)) == ["midnight"]
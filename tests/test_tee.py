@@ -0,0 +1,118 @@
+"""Tests for the stream tee feeding mirrored uploads."""
+from __future__ import annotations
+
+import asyncio
+
+from custom_components.infomaniak_kdrive import tee as tee_module
+from custom_components.infomaniak_kdrive.tee import StreamTee
+
+from .common import collect, iter_bytes, random_bytes
+
+DATA = random_bytes(100_000)
+
+
+class Source:
+    def __init__(self, data: bytes = DATA, fail_after: int | None = None) -> None:
+        self.data = data
+        self.fail_after = fail_after
+        self.opened = 0
+        self.read = 0
+
+    async def open(self):
+        self.opened += 1
+        return self._stream()
+
+    async def _stream(self):
+        async for part in iter_bytes(self.data, 1000):
+            if self.fail_after is not None and self.read >= self.fail_after:
+                raise OSError("read error")
+            self.read += 1
+            yield part
+
+
+async def test_consumers_share_one_read() -> None:
+    source = Source()
+    tee = StreamTee(source.open, 2)
+
+    first, second = await asyncio.gather(
+        collect(await tee.opener(0)()), collect(await tee.opener(1)())
+    )
+    await tee.aclose()
+
+    assert first == second == DATA
+    assert source.opened == 1
+
+
+async def test_fast_consumer_stays_within_the_queue(monkeypatch) -> None:
+    monkeypatch.setattr(tee_module, "TEE_QUEUE_SIZE", 4)
+    source = Source()
+    tee = StreamTee(source.open, 2)
+    fast = await tee.opener(0)()
+    slow = await tee.opener(1)()
+
+    for _ in range(5):
+        await anext(fast)
+    await asyncio.sleep(0.01)
+    # The pump waits for `slow` to take one of its 4 queued parts
+    assert source.read == 5
+
+    tee.detach(0)
+    assert await collect(slow) == DATA
+    await tee.aclose()
+
+
+async def test_detached_consumer_does_not_block_the_other() -> None:
+    source = Source()
+    tee = StreamTee(source.open, 2)
+    stream = await tee.opener(0)()
+    await tee.opener(1)()  # never read
+    tee.detach(1)
+
+    assert await collect(stream) == DATA
+    await tee.aclose()
+
+
+async def test_consumer_that_never_starts() -> None:
+    source = Source()
+    tee = StreamTee(source.open, 2)
+    tee.detach(1)
+
+    assert await collect(await tee.opener(0)()) == DATA
+    await tee.aclose()
+
+
+async def test_second_open_reads_the_source_again() -> None:
+    source = Source()
+    tee = StreamTee(source.open, 2)
+    first = await tee.opener(0)()
+    tee.detach(1)
+    assert await collect(first) == DATA
+
+    # A retried upload opens its stream again
+    assert await collect(await tee.opener(0)()) == DATA
+    assert source.opened == 2
+    await tee.aclose()
+
+
+async def test_read_error_reaches_every_consumer() -> None:
+    tee = StreamTee(Source(fail_after=20).open, 2)
+
+    results = await asyncio.gather(
+        collect(await tee.opener(0)()), collect(await tee.opener(1)()), return_exceptions=True
+    )
+    await tee.aclose()
+
+    assert all(isinstance(result, OSError) for result in results)
+
+
+async def test_close_stops_a_stalled_pump(monkeypatch) -> None:
+    monkeypatch.setattr(tee_module, "TEE_QUEUE_SIZE", 1)
+    tee = StreamTee(Source().open, 2)
+    stream = await tee.opener(0)()
+    await tee.opener(1)()  # opened, never read
+    await anext(stream)
+    await asyncio.sleep(0.01)
+
+    await tee.aclose()
+
+    assert tee._pump.done()
@@ -0,0 +1,108 @@
+"""Tests for the upload bandwidth limiter."""
+from __future__ import annotations
+
+from datetime import time as dt_time
+import time
+
+import pytest
+
+from custom_components.infomaniak_kdrive import client as client_module
+from custom_components.infomaniak_kdrive.throttle import BandwidthLimiter, parse_schedule
+
+from .common import collect, iter_bytes, opener, random_bytes
+
+
+def test_parse_schedule() -> None:
+    assert parse_schedule("08:00-23:00=512, 23:00-08:00=0") == [
+        (dt_time(8, 0), dt_time(23, 0), 512),
+        (dt_time(23, 0), dt_time(8, 0), 0),
+    ]
+    assert parse_schedule("") == []
+
+
+@pytest.mark.parametrize("value", ["8-23=512", "08:00-23:00", "08:00-23:00=fast"])
+def test_parse_schedule_rejects_bad_input(value) -> None:
+    with pytest.raises(ValueError):
+        parse_schedule(value)
+
+
+def test_unlimited() -> None:
+    limiter = BandwidthLimiter()
+    assert not limiter.enabled
+    assert limiter.rate is None
+
+
+@pytest.mark.parametrize(
+    ("now", "rate"),
+    [
+        ("2026-01-01 12:00:00", 512 * 1024),
+        ("2026-01-01 23:30:00", None),  # window wrapping midnight, unlimited
+        ("2026-01-01 07:59:00", None),
+    ],
+)
+async def test_schedule_picks_the_current_window(hass, freezer, now, rate) -> None:
+    await hass.config.async_set_time_zone("UTC")
+    freezer.move_to(now)
+    limiter = BandwidthLimiter(100, parse_schedule("08:00-23:00=512, 23:00-08:00=0"))
+    assert limiter.enabled
+    assert limiter.rate == rate
+
+
+async def test_limit_outside_the_schedule(hass, freezer) -> None:
+    await hass.config.async_set_time_zone("UTC")
+    freezer.move_to("2026-01-01 12:00:00")
+    limiter = BandwidthLimiter(100, parse_schedule("00:00-06:00=0"))
+    assert limiter.rate == 100 * 1024
+
+
+async def test_pace_keeps_to_the_rate() -> None:
+    limiter = BandwidthLimiter(4096)  # 4 MiB/s
+    data = bytes(2 * 1024 * 1024)
+
+    start = time.monotonic()
+    assert await collect(limiter.pace(iter_bytes(data, 100_000))) == data
+    elapsed = time.monotonic() - start
+
+    assert 0.4 <= elapsed < 1.5
+
+
+async def test_pace_bytes_keeps_to_the_rate() -> None:
+    limiter = BandwidthLimiter(4096)
+    data = bytes(1024 * 1024)
+
+    start = time.monotonic()
+    assert await collect(limiter.pace_bytes(data)) == data
+
+    assert 0.2 <= time.monotonic() - start < 1
+
+
+async def test_rate_change_applies_mid_transfer() -> None:
+    limiter = BandwidthLimiter(64)  # 64 KiB/s: 4 MiB would take a minute
+    data = bytes(4 * 1024 * 1024)
+    received = 0
+    start = time.monotonic()
+    async for part in limiter.pace(iter_bytes(data)):
+        received += len(part)
+        if received == 64 * 1024:
+            limiter.configure(0)
+
+    assert received == len(data)
+    assert time.monotonic() - start < 3
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+async def test_upload_keeps_to_the_rate(make_client, kdrive, monkeypatch, chunked) -> None:
+    # 2 MiB at 2 MiB/s, against the fake server
+    if chunked:
+        monkeypatch.setattr(client_module, "UPLOAD_CHUNK_SIZE", 256 * 1024)
+        monkeypatch.setattr(client_module, "DIRECT_UPLOAD_DEFAULT_SIZE", 0)
+    client = make_client(bandwidth_limit=2048, upload_concurrency=4)
+    data = random_bytes(2 * 1024 * 1024)
+
+    start = time.monotonic()
+    await client.upload_stream_to_folder(filename="a.tar", open_stream=opener(data), size_hint=len(data))
+    elapsed = time.monotonic() - start
+
+    assert kdrive.by_name("a.tar").data == data
+    assert kdrive.count("chunk" if chunked else "upload") == (8 if chunked else 1)
+    assert 0.8 <= elapsed < 2
@@ -0,0 +1,81 @@
+"""Tests for the client-side stream transforms."""
+from __future__ import annotations
+
+import pytest
+
+from custom_components.infomaniak_kdrive.const import XF_AESGCM, XF_ZSTD
+from custom_components.infomaniak_kdrive.transform import (
+    TransformError,
+    apply_transforms,
+    revert_transforms,
+)
+
+from .common import collect, iter_bytes, random_bytes
+
+# Compressible, with a random tail
+DATA = b"homeassistant " * 100_000 + random_bytes(300_000)
+
+
+@pytest.mark.parametrize("transforms", [[XF_ZSTD], [XF_AESGCM], [XF_ZSTD, XF_AESGCM]])
+async def test_round_trip(hass, transforms) -> None:
+    stored = await collect(apply_transforms(hass, iter_bytes(DATA), transforms, "secret"))
+    assert stored != DATA
+
+    restored = await collect(revert_transforms(hass, iter_bytes(stored, 1000), transforms, "secret"))
+
+    assert restored == DATA
+
+
+async def test_empty_stream(hass) -> None:
+    transforms = [XF_ZSTD, XF_AESGCM]
+    stored = await collect(apply_transforms(hass, iter_bytes(b""), transforms, "secret"))
+    assert await collect(revert_transforms(hass, iter_bytes(stored), transforms, "secret")) == b""
+
+
+async def test_compression_shrinks_data(hass) -> None:
+    stored = await collect(apply_transforms(hass, iter_bytes(DATA), [XF_ZSTD], None))
+    assert len(stored) < len(DATA) / 2
+
+
+async def test_encryption_is_not_deterministic(hass) -> None:
+    # Why encrypted uploads never resume
+    first = await collect(apply_transforms(hass, iter_bytes(DATA), [XF_AESGCM], "secret"))
+    second = await collect(apply_transforms(hass, iter_bytes(DATA), [XF_AESGCM], "secret"))
+    assert first != second
+
+
+@pytest.mark.parametrize("transforms", [[XF_ZSTD], [XF_AESGCM], [XF_ZSTD, XF_AESGCM]])
+@pytest.mark.parametrize("cut", [1, 100, 50_000])
+async def test_truncated_stream_is_detected(hass, transforms, cut) -> None:
+    stored = await collect(apply_transforms(hass, iter_bytes(DATA), transforms, "secret"))
+
+    with pytest.raises(TransformError):
+        await collect(revert_transforms(hass, iter_bytes(stored[:-cut]), transforms, "secret"))
+
+
+@pytest.mark.parametrize("transforms", [[XF_ZSTD], [XF_AESGCM]])
+async def test_trailing_data_is_detected(hass, transforms) -> None:
+    stored = await collect(apply_transforms(hass, iter_bytes(DATA), transforms, "secret"))
+
+    with pytest.raises(TransformError):
+        await collect(revert_transforms(hass, iter_bytes(stored + b"junk"), transforms, "secret"))
+
+
+async def test_wrong_key(hass) -> None:
+    stored = await collect(apply_transforms(hass, iter_bytes(DATA), [XF_AESGCM], "secret"))
+
+    with pytest.raises(TransformError):
+        await collect(revert_transforms(hass, iter_bytes(stored), [XF_AESGCM], "other"))
+
+
+async def test_corrupted_frame(hass) -> None:
+    stored = bytearray(await collect(apply_transforms(hass, iter_bytes(DATA), [XF_AESGCM], "secret")))
+    stored[len(stored) // 2] ^= 1
+
+    with pytest.raises(TransformError):
+        await collect(revert_transforms(hass, iter_bytes(bytes(stored)), [XF_AESGCM], "secret"))
+
+
+def test_encryption_needs_a_key(hass) -> None:
+    with pytest.raises(TransformError):
+        apply_transforms(hass, iter_bytes(DATA), [XF_AESGCM], None)